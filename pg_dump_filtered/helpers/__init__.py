@@ -15,3 +15,6 @@
 from pg_dump_filtered.helpers.schema_utils import SchemaUtils
 from pg_dump_filtered.helpers.request_builder import RequestBuilder
 from pg_dump_filtered.helpers.dump_builder import DumpBuilder
+from pg_dump_filtered.helpers.stream_builder import StreamBuilder
+from pg_dump_filtered.helpers.key_set_cache import KeySetCache
+from pg_dump_filtered.helpers.key_set_builder import KeySetBuilder
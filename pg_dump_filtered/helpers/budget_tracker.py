@@ -0,0 +1,134 @@
+# coding: utf-8
+
+# Copyright (C) 2017 Open Path View, Maison Du Libre
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Contributors: Benjamin BERNARD <benjamin.bernard@openpathview.fr>
+# Email: team@openpathview.fr
+# Description: Enforce rows and bytes budgets on the COPY datas while they are streamed.
+
+import io
+import logging
+import threading
+import psycopg2
+import psycopg2.extensions
+
+from pg_dump_filtered import model
+
+class BudgetExceeded(Exception):
+    """
+    Raised when a table or the whole dump exceeds its budget.
+    """
+    pass
+
+class BudgetTracker():
+    """
+    Counts the rows and bytes exported for each table and for the whole dump.
+    Can be shared by the builders of parallel sessions.
+    """
+
+    def __init__(self, table_budget: model.Budget=None, total_budget: model.Budget=None):
+        """
+        Instanciate a budget tracker.
+
+        :param table_budget: Budget of each table, None for no limit.
+        :param total_budget: Budget of the whole dump, None for no limit.
+        """
+        self.logger = logging.getLogger(__name__)
+        self._table_budget = table_budget if table_budget is not None else model.Budget(max_rows=None, max_bytes=None)
+        self._total_budget = total_budget if total_budget is not None else model.Budget(max_rows=None, max_bytes=None)
+        self._lock = threading.Lock()
+        self.total_rows = 0
+        self.total_bytes = 0
+
+    def count(self, table_name: str, rows: int, nbytes: int):
+        """
+        Count datas exported for the whole dump, fails if the total budget is exceeded.
+
+        :param table_name: Table the datas belong to.
+        :param rows: Number of rows.
+        :param nbytes: Size in bytes.
+        """
+        with self._lock:
+            self.total_rows += rows
+            self.total_bytes += nbytes
+            total_rows, total_bytes = self.total_rows, self.total_bytes
+
+        self._check(self._total_budget, rows=total_rows, nbytes=total_bytes, what="dump (while exporting {})".format(table_name))
+
+    def check_table(self, table_name: str, rows: int, nbytes: int):
+        """
+        Fails if a table exceeds the table budget.
+
+        :param table_name: The table.
+        :param rows: Number of rows exported for this table.
+        :param nbytes: Size in bytes exported for this table.
+        """
+        self._check(self._table_budget, rows=rows, nbytes=nbytes, what="table {}".format(table_name))
+
+    def _check(self, budget: model.Budget, rows: int, nbytes: int, what: str):
+        """
+        Raise BudgetExceeded if the rows or the bytes exceed the budget.
+        """
+        if budget.max_rows is not None and rows > budget.max_rows:
+            raise BudgetExceeded("Rows budget exceeded for {} : more than {} rows".format(what, budget.max_rows))
+        if budget.max_bytes is not None and nbytes > budget.max_bytes:
+            raise BudgetExceeded("Bytes budget exceeded for {} : more than {} bytes".format(what, budget.max_bytes))
+
+    def writer(self, destination, table_name: str, conn: psycopg2.extensions.connection) -> "BudgetWriter":
+        """
+        Wrap the destination of a table COPY datas.
+
+        :param destination: File like object the datas are written to.
+        :param table_name: Table being exported.
+        :param conn: Connexion running the COPY, its request is cancelled when the budget is exceeded.
+        :return: Counting file like object.
+        """
+        return BudgetWriter(destination=destination, table_name=table_name, tracker=self, conn=conn)
+
+class BudgetWriter():
+    """
+    File like object counting the COPY datas written to its destination.
+    It isn't a text file so psycopg2 writes raw bytes, they are decoded if the destination is a text file.
+    """
+
+    def __init__(self, destination, table_name: str, tracker: BudgetTracker, conn: psycopg2.extensions.connection):
+        """
+        Instanciate a budget writer, see BudgetTracker.writer.
+        """
+        self.logger = logging.getLogger(__name__)
+        self._destination = destination
+        self._table_name = table_name
+        self._tracker = tracker
+        self._conn = conn
+        self._encoding = psycopg2.extensions.encodings[conn.encoding] if isinstance(destination, io.TextIOBase) else None
+        self.rows = 0
+        self.bytes = 0
+
+    def write(self, data):
+        """
+        Count and write COPY datas, the server request is cancelled if the budget is exceeded.
+        """
+        rows = data.count(b"\n")
+        nbytes = len(data)
+        self.rows += rows
+        self.bytes += nbytes
+
+        try:
+            self._tracker.check_table(self._table_name, rows=self.rows, nbytes=self.bytes)
+            self._tracker.count(self._table_name, rows=rows, nbytes=nbytes)
+        except BudgetExceeded as e:
+            self.logger.error("%s, cancelling the request", e)
+            self._conn.cancel()
+            raise
+
+        return self._destination.write(data if self._encoding is None else data.decode(self._encoding))
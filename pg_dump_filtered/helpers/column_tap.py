@@ -0,0 +1,111 @@
+# coding: utf-8
+
+# Copyright (C) 2017 Open Path View, Maison Du Libre
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Contributors: Benjamin BERNARD <benjamin.bernard@openpathview.fr>
+# Email: team@openpathview.fr
+# Description: Capture some columns values from the COPY datas while they are written.
+
+import inspect
+import io
+import logging
+import re
+import psycopg2
+import psycopg2.extensions
+from typing import List, Dict, Callable, Union, Generator
+
+from pg_dump_filtered import model
+
+COPY_NULL = "\\N"
+COPY_DELIMITER = "\t"
+
+COPY_ESCAPES = {
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+    "v": "\v",
+    "\\": "\\",
+}
+COPY_ESCAPE_REGEX = re.compile(r"\\(.)", re.DOTALL)
+
+# A tap receives the values of a column, it's a callback or a generator (values are sent to it)
+ColumnTap = Union[Callable[[str], None], Generator[None, str, None]]
+
+def unescape_copy_text(field: str) -> str:
+    """
+    Decode a field of the COPY text format.
+
+    :param field: Raw field.
+    :return: The value, None for NULL.
+    """
+    if field == COPY_NULL:
+        return None
+    if "\\" not in field:
+        return field
+    return COPY_ESCAPE_REGEX.sub(lambda m: COPY_ESCAPES.get(m.group(1), m.group(1)), field)
+
+class ColumnTapWriter():
+    """
+    File like object parsing the COPY text datas written to its destination, line by line,
+    and sending the values of some columns to their taps.
+    It isn't a text file so psycopg2 writes raw bytes, they are decoded if the destination is a text file.
+    """
+
+    def __init__(self, destination, cols: List[model.ColumnRef], taps: Dict[str, ColumnTap], conn: psycopg2.extensions.connection):
+        """
+        Instanciate a column tap writer.
+
+        :param destination: File like object the datas are written to.
+        :param cols: Columns of the COPY datas, in order.
+        :param taps: Taps of the columns, column_name => callback or generator.
+        :param conn: Connexion running the COPY, used to decode datas.
+        """
+        self.logger = logging.getLogger(__name__)
+        self._destination = destination
+        self._python_encoding = psycopg2.extensions.encodings[conn.encoding]
+        self._decode_output = isinstance(destination, io.TextIOBase)
+        self._pending = b""  # end of the datas that isn't a full line yet
+
+        cols_names = [c.column_name for c in cols]
+        self._taps = []  # (column index, tap)
+        for column_name, tap in taps.items():
+            if column_name not in cols_names:
+                raise ValueError("Tapped column {!r} isn't exported, exported columns are {!r}".format(column_name, cols_names))
+            if inspect.isgenerator(tap) and inspect.getgeneratorstate(tap) == inspect.GEN_CREATED:
+                next(tap)  # generators must be started before values are sent
+            self._taps.append((cols_names.index(column_name), tap))
+
+    def _tap_line(self, line: bytes):
+        """
+        Send the tapped values of a COPY line to their taps.
+        """
+        fields = line.decode(self._python_encoding).split(COPY_DELIMITER)
+        for index, tap in self._taps:
+            value = unescape_copy_text(fields[index])
+            if inspect.isgenerator(tap):
+                tap.send(value)
+            else:
+                tap(value)
+
+    def write(self, data):
+        """
+        Tap and write COPY datas.
+        """
+        lines = (self._pending + data).split(b"\n")
+        self._pending = lines.pop()
+        for line in lines:
+            self._tap_line(line)
+
+        return self._destination.write(data.decode(self._python_encoding) if self._decode_output else data)
@@ -16,14 +16,27 @@
 # Email: team@openpathview.fr
 # Description: Utils function to generate SQL/PG dump.
 
+import hashlib
 import logging
+import threading
 import psycopg2
-import psycopg2.extras
-from typing import TextIO, List, Dict
+import psycopg2.extensions
+from typing import TextIO, List, Dict, Callable
+from pg_dump_filtered import model
 from pg_dump_filtered.helpers import SchemaUtils
+from pg_dump_filtered.helpers.budget_tracker import BudgetTracker
+from pg_dump_filtered.helpers.column_tap import ColumnTapWriter, ColumnTap, unescape_copy_text
 
 REQ_SELECT_DUMP = "COPY ({select}) TO STDOUT"
 
+# DELETE statements are rendered by the server, format() quotes the keys values as literals
+REQ_DELETE_STATEMENTS = "COPY (SELECT format({statement_format}, {pkeys}) FROM {from_table_name} {join_statements} {where}) TO STDOUT"
+DELETE_STATEMENT_FORMAT = "DELETE FROM {table_name} WHERE {where};"
+
+RESTORE_MODE_DELETE = "delete"  # rows are deleted then copied back, with triggers disabled
+RESTORE_MODE_UPSERT = "upsert"  # rows are copied in a staging table then merged, only changed rows are written
+RESTORE_MODES = [RESTORE_MODE_DELETE, RESTORE_MODE_UPSERT]
+
 DP_HEADER = """--
 -- PostgreSQL database dump
 --
@@ -42,34 +55,189 @@ SET row_security = off;
 DP_COPY_HEADER = """
 -- Table : {table_name}
 
-COPY public.{table_name} ({cols_names}) FROM stdin;"""
+"""
+DP_COPY_FROM = "COPY {copy_table_name} ({cols_names}) FROM stdin"
 DP_STDIN_END = "\.\n\n"
 
 
 DP_DISABLE_TABLE_TRIGGERS = """
-ALTER TABLE public.{table_name} DISABLE TRIGGER ALL;
+ALTER TABLE {table_name} DISABLE TRIGGER ALL;
 """
 
 DP_ENABLE_TABLE_TRIGGERS = """
-ALTER TABLE public.{table_name} ENABLE TRIGGER ALL;
+ALTER TABLE {table_name} ENABLE TRIGGER ALL;
+"""
+
+DP_CREATE_STAGING_TABLE = """
+CREATE TEMP TABLE {staging_table_name} (LIKE {table_name} INCLUDING DEFAULTS);
+"""
+
+# Identity values are written as supplied, as COPY does (GENERATED ALWAYS AS IDENTITY columns reject them otherwise)
+DP_MERGE_STAGING_TABLE = """INSERT INTO {table_name} AS dest ({cols_names}) OVERRIDING SYSTEM VALUE
+SELECT {cols_names} FROM {staging_table_name}
+ON CONFLICT {conflict_target} {conflict_action};
+"""
+
+# Values are compared as text, some types (json, xml ...) have no equality operator
+DP_CONFLICT_UPDATE = """DO UPDATE SET {set_cols}
+WHERE ({dest_cols}) IS DISTINCT FROM ({excluded_cols})"""
+
+DP_CONFLICT_NOTHING = "DO NOTHING"
+
+DP_DROP_STAGING_TABLE = """DROP TABLE {staging_table_name};
+"""
+
+DP_STAGING_TABLE_NAME = "pg_temp.pg_dump_filtered_staging_{table_hash}"
+
+DP_DROP_INDEXES_HEADER = """
+-- Fast load : secondary indexes are dropped during the load and created back afterward
+
+"""
+
+DP_DROP_INDEX = """DROP INDEX IF EXISTS {index_name};
+"""
+
+DP_CREATE_INDEXES_HEADER = """
+-- Fast load : creating secondary indexes back
+
 """
 
+DP_ANALYZE_TABLE = """ANALYZE {table_name};
+"""
+
+class DumpStopped(Exception):
+    """
+    Raised when a dump stage is stopped between two tables because another stage failed.
+    """
+    pass
+
+def make_staging_table_name(table_name: str) -> str:
+    """
+    Name of the temporary staging table of a table in upsert mode.
+    The table name is hashed so that the identifier stays under the 63 bytes Postgres limit :
+    a truncated name could be shared by two tables.
+
+    :param table_name: Schema qualified table name.
+    """
+    return DP_STAGING_TABLE_NAME.format(table_hash=hashlib.md5(table_name.encode("utf-8")).hexdigest())
+
+class StatementsWriter():
+    """
+    File like object receiving rendered statements as single column COPY text datas, each line is unescaped
+    and written as a statement. It isn't a text file so psycopg2 writes raw bytes.
+    """
+
+    def __init__(self, write: Callable[[str], None], conn: psycopg2.extensions.connection):
+        """
+        Instanciate a statements writer.
+
+        :param write: Function writing statements to the dump.
+        :param conn: Connexion running the COPY, used to decode datas.
+        """
+        self._write = write
+        self._python_encoding = psycopg2.extensions.encodings[conn.encoding]
+        self._pending = b""  # end of the datas that isn't a full line yet
+
+    def write(self, data):
+        """
+        Unescape and write the complete lines, escaped newlines in the values never split a line.
+        """
+        lines = (self._pending + data).split(b"\n")
+        self._pending = lines.pop()
+        if lines:
+            self._write("".join([unescape_copy_text(line.decode(self._python_encoding)) + "\n" for line in lines]))
+
 class DumpBuilder():
 
-    def __init__(self, schema_utils: SchemaUtils, conn: psycopg2.extensions.connection, dump_file: TextIO):
+    def __init__(
+            self,
+            schema_utils: SchemaUtils,
+            conn: psycopg2.extensions.connection,
+            dump_file: TextIO,
+            restore_mode: str=RESTORE_MODE_DELETE,
+            budget_tracker: BudgetTracker=None,
+            column_taps: Dict[str, Dict[str, ColumnTap]]=None,
+            header: bool=True,
+            delete_budget_tracker: BudgetTracker=None,
+            stop_event: threading.Event=None):
         """
         Instanciate a request builder.
 
         :param schema_utils: Schema utils used to fetch some related schema informations.
         :param conn: database connexion.
         :param dump_file: File where the dump will be made.
+        :param restore_mode: How the dump will update the restored tables, RESTORE_MODE_DELETE or RESTORE_MODE_UPSERT.
+        :param budget_tracker: Enforce rows and bytes budgets on the COPY datas, None for no limit.
+        :param column_taps: Callbacks or generators receiving the values of some columns while they are dumped,
+                            table_name => {column_name => tap}.
+        :param header: Write the dump header, False when the statements are appended to another dump.
+        :param delete_budget_tracker: Enforce rows and bytes budgets on the delete statements (one statement per exported row),
+                                      None for no limit.
+        :param stop_event: When set, the dump stops before the next table (DumpStopped is raised), None to never stop.
         """
+        if restore_mode not in RESTORE_MODES:
+            raise ValueError("Unknown restore mode {!r}, should be one of {!r}".format(restore_mode, RESTORE_MODES))
+
         self._schema_utils = schema_utils
+        self._restore_mode = restore_mode
+        self._budget_tracker = budget_tracker
+        self._delete_budget_tracker = delete_budget_tracker
+        self._column_taps = column_taps if column_taps is not None else {}
         self._dump_file = dump_file
         self._conn = conn
+        self._stop_event = stop_event
         self.logger = logging.getLogger(__name__)
 
-        self._dump_file.write(DP_HEADER)
+        if header:
+            self._write(DP_HEADER)
+
+    def _write(self, statements: str):
+        """
+        Write SQL statements to the dump.
+
+        :param statements: SQL statements.
+        """
+        self._dump_file.write(statements)
+
+    def _data_destination(self, table_name: str, cols: List[model.ColumnRef], destination):
+        """
+        Wrap the destination of a table COPY datas to send the tapped columns values to their taps
+        and to count them against the budgets.
+
+        :param table_name: Table being dumped.
+        :param cols: Dumped columns.
+        :param destination: File like object the datas are written to.
+        :return: File like object the COPY datas should be written to.
+        """
+        if table_name in self._column_taps:
+            destination = ColumnTapWriter(destination=destination, cols=cols, taps=self._column_taps[table_name], conn=self._conn)
+        if self._budget_tracker is not None:
+            destination = self._budget_tracker.writer(destination=destination, table_name=table_name, conn=self._conn)
+        return destination
+
+    def _copy_data(self, table_name: str, cols: List[model.ColumnRef], copy_from_statement: str, select_request: str):
+        """
+        Write the COPY FROM statement and the selected datas to the dump.
+
+        :param table_name: Table being dumped.
+        :param cols: Dumped columns.
+        :param copy_from_statement: COPY ... FROM stdin statement the datas are restored with.
+        :param select_request: Select request, which request the table's data.
+        """
+        self._write(copy_from_statement + ";\n")
+        cur = self._conn.cursor()
+        destination = self._data_destination(table_name=table_name, cols=cols, destination=self._dump_file)
+        cur.copy_expert(REQ_SELECT_DUMP.format(select=select_request), destination)
+        self._write(DP_STDIN_END)
+
+    def _check_stopped(self, table_name: str):
+        """
+        Stop the dump if another stage asked it to.
+
+        :param table_name: Table that was about to be dumped.
+        """
+        if self._stop_event is not None and self._stop_event.is_set():
+            raise DumpStopped("Dump stopped before {}, another stage failed".format(table_name))
 
     def _enable_triggers(self, table_name: str):
         """
@@ -77,7 +245,7 @@ class DumpBuilder():
 
         :param table_name: Table where triggers will be enabled.
         """
-        self._dump_file.write(DP_ENABLE_TABLE_TRIGGERS.format(table_name=table_name))
+        self._write(DP_ENABLE_TABLE_TRIGGERS.format(table_name=table_name))
 
     def _disable_triggers(self, table_name: str):
         """
@@ -85,7 +253,7 @@ class DumpBuilder():
 
         :param table_name: Table where triggers will be disabled.
         """
-        self._dump_file.write(DP_DISABLE_TABLE_TRIGGERS.format(table_name=table_name))
+        self._write(DP_DISABLE_TABLE_TRIGGERS.format(table_name=table_name))
 
     def dump(self, table_name: str, select_request: str):
         """
@@ -96,28 +264,75 @@ class DumpBuilder():
         :param select_request: Select request, which request the table's data.
         """
         self.logger.debug("dump for table_name: %s", table_name)
+        self._check_stopped(table_name=table_name)
 
-        # disable triggers to prevent key relations errors (depending on COPY order in tables)
-        self._disable_triggers(table_name)
-
-        # Making COPY header
-        cols = self._schema_utils.fetch_cols_names(table_name=table_name)
+        cols = self._schema_utils.fetch_exported_cols_names(table_name=table_name)
         cols_names_list = ["\"{cname}\"".format(cname=c.column_name) for c in cols]  # prevent uppercases columns names errors
         cols_names = ", ".join(cols_names_list)
-        header = DP_COPY_HEADER.format(table_name=table_name, cols_names=cols_names)
-        self._dump_file.write(header + "\n")
-        self.logger.debug("Generated COPY statement for dump file : %s", header)
+
+        self._write(DP_COPY_HEADER.format(table_name=table_name))
+
+        if self._restore_mode == RESTORE_MODE_UPSERT:
+            # datas are copied in a staging table and merged afterward
+            copy_table_name = make_staging_table_name(table_name=table_name)
+            self._write(DP_CREATE_STAGING_TABLE.format(staging_table_name=copy_table_name, table_name=table_name))
+        else:
+            # disable triggers to prevent key relations errors (depending on COPY order in tables)
+            copy_table_name = table_name
+            self._disable_triggers(table_name)
+
+        # Making COPY header
+        copy_from = DP_COPY_FROM.format(copy_table_name=copy_table_name, cols_names=cols_names)
+        self.logger.debug("Generated COPY statement for dump file : %s", copy_from)
 
         # Execute "dump" request based on select
-        cur = self._conn.cursor()
-        cur.copy_expert(REQ_SELECT_DUMP.format(select=select_request), self._dump_file)
-        self._dump_file.write(DP_STDIN_END)
+        self._copy_data(table_name=table_name, cols=cols, copy_from_statement=copy_from, select_request=select_request)
 
-        # Enabling triggers back
-        self._enable_triggers(table_name)
+        if self._restore_mode == RESTORE_MODE_UPSERT:
+            self._merge_staging_table(table_name=table_name, staging_table_name=copy_table_name, cols=cols)
+        else:
+            # Enabling triggers back
+            self._enable_triggers(table_name)
 
         self.logger.debug("Dump saved into dump_file")
 
+    def _merge_staging_table(self, table_name: str, staging_table_name: str, cols: List[model.ColumnRef]):
+        """
+        Merge the staging table into table_name with an INSERT ... ON CONFLICT, only rows that differ are updated.
+        Triggers are disabled during the merge to prevent key relations errors (depending on merge order in tables).
+
+        :param table_name: Table where datas are merged.
+        :param staging_table_name: Staging table containing the dumped datas.
+        :param cols: Dumped columns.
+        """
+        pkeys_cols = self._schema_utils.fetch_primary_keys(table_name=table_name)
+        pkeys_names = [c.column_name for c in pkeys_cols]
+        updated_names = ["\"{cname}\"".format(cname=c.column_name) for c in cols if c.column_name not in pkeys_names]
+
+        if pkeys_names == []:
+            self.logger.warning("No primary key for %s, rows will only be inserted", table_name)
+            conflict_target = ""
+        else:
+            conflict_target = "(" + ", ".join(["\"{cname}\"".format(cname=n) for n in pkeys_names]) + ")"
+
+        if pkeys_names == [] or updated_names == []:
+            conflict_action = DP_CONFLICT_NOTHING
+        else:
+            conflict_action = DP_CONFLICT_UPDATE.format(
+                set_cols=", ".join(["{cname} = EXCLUDED.{cname}".format(cname=n) for n in updated_names]),
+                dest_cols=", ".join(["CAST(dest.{cname} AS text)".format(cname=n) for n in updated_names]),
+                excluded_cols=", ".join(["CAST(EXCLUDED.{cname} AS text)".format(cname=n) for n in updated_names]))
+
+        self._disable_triggers(table_name)
+        self._write(DP_MERGE_STAGING_TABLE.format(
+            table_name=table_name,
+            staging_table_name=staging_table_name,
+            cols_names=", ".join(["\"{cname}\"".format(cname=c.column_name) for c in cols]),
+            conflict_target=conflict_target,
+            conflict_action=conflict_action))
+        self._enable_triggers(table_name)
+        self._write(DP_DROP_STAGING_TABLE.format(staging_table_name=staging_table_name))
+
     def dump_tables(self, select_requests: Dict[str, str]):
         """
         Dump all data corresponding to select requests for each table_name.
@@ -129,6 +344,45 @@ class DumpBuilder():
         for table_name, select in select_requests.items():
             self.dump(table_name=table_name, select_request=select)
 
+    def drop_indexes(self, table_names: List[str]) -> List[model.Index]:
+        """
+        Drop the secondary indexes of the tables, so that they aren't maintained row by row while datas are loaded.
+        Indexes backing a constraint (primary keys, unique constraints ...) and unique indexes are kept, they are used by the
+        restore statements and reject duplicated rows.
+
+        :param table_names: Tables that will be loaded.
+        :return: Dropped indexes, to be created back with create_indexes.
+        """
+        indexes = [index for tname in table_names for index in self._schema_utils.fetch_secondary_indexes(table_name=tname)]
+        self.logger.debug("Dropping indexes : %r", [index.index_name for index in indexes])
+
+        self._write(DP_DROP_INDEXES_HEADER)
+        for index in indexes:
+            self._write(DP_DROP_INDEX.format(index_name=index.index_name))
+
+        return indexes
+
+    def create_indexes(self, indexes: List[model.Index]):
+        """
+        Create indexes back, once datas are loaded.
+
+        :param indexes: Indexes dropped by drop_indexes.
+        """
+        self.logger.debug("Creating indexes : %r", [index.index_name for index in indexes])
+        self._write(DP_CREATE_INDEXES_HEADER)
+        for index in indexes:
+            self._write(index.definition + ";\n")
+
+    def analyze_tables(self, table_names: List[str]):
+        """
+        Update the planner statistics of the loaded tables.
+
+        :param table_names: Loaded tables.
+        """
+        self._write("\n")
+        for tname in table_names:
+            self._write(DP_ANALYZE_TABLE.format(table_name=tname))
+
     def generate_primary_keys_delete_statements(self, from_table_name: str, displayed_fields_table_name: str, join_statements: str, where_filter: str=""):
         """
         Will generate a delete statement for all selected datas.
@@ -137,29 +391,39 @@ class DumpBuilder():
         :param
         """
         self.logger.debug("Generating delation statements for table : %s", displayed_fields_table_name)
-        self._dump_file.write("""-- delete statements for partial dump of table : {table_name}\n""".format(table_name=displayed_fields_table_name))
+        self._check_stopped(table_name=displayed_fields_table_name)
         pkeys_cols = self._schema_utils.fetch_primary_keys(table_name=displayed_fields_table_name)
+        if pkeys_cols == []:
+            self.logger.warning("No primary key for %s, no delete statements generated", displayed_fields_table_name)
+            return
+
+        self._write("""-- delete statements for partial dump of table : {table_name}\n""".format(table_name=displayed_fields_table_name))
         where = "" if where_filter == "" or where_filter is None else " WHERE " + where_filter
 
         # disabling triggers, ugly but can't do anything else
         # this is use to prevent cascade delation as our purpose is to update data not delete all related ones
         self._disable_triggers(displayed_fields_table_name)
 
-        # select with pkeys cols to gets ids
-        select_view = ", ".join([c.table_name + "." + c.column_name for c in pkeys_cols])
-        select_keys_values_req = "SELECT {select_view} FROM {from_table_name} {join_statements} {where}".format(
-            select_view=select_view, from_table_name=from_table_name, join_statements=join_statements, where=where)
-        cur = self._conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        self.logger.debug(select_keys_values_req)
-        cur.execute(select_keys_values_req)
-        for row in cur:
-            delete_where = " AND ".join(["{tname}.{cname} = '{id}'".format(tname=c.table_name, cname=c.column_name, id=row[c.column_name]) for c in pkeys_cols])
-            self._dump_file.write("DELETE FROM public.{table_name} WHERE {where}; \n".format(table_name=displayed_fields_table_name, where=delete_where))
+        # DELETE statements are rendered by the server and streamed into the dump
+        statement_format = DELETE_STATEMENT_FORMAT.format(
+            table_name=displayed_fields_table_name.replace("%", "%%"),
+            where=" AND ".join(["\"{cname}\" = %L".format(cname=c.column_name.replace("%", "%%")) for c in pkeys_cols]))
+        delete_statements_req = REQ_DELETE_STATEMENTS.format(
+            statement_format="'" + statement_format.replace("'", "''") + "'",
+            pkeys=", ".join([c.table_name + "." + c.column_name for c in pkeys_cols]),
+            from_table_name=from_table_name,
+            join_statements=join_statements,
+            where=where)
+        self.logger.debug(delete_statements_req)
+        destination = StatementsWriter(write=self._write, conn=self._conn)
+        if self._delete_budget_tracker is not None:
+            destination = self._delete_budget_tracker.writer(destination=destination, table_name=displayed_fields_table_name, conn=self._conn)
+        self._conn.cursor().copy_expert(delete_statements_req, destination)
 
         # Setting triggers back
         self._enable_triggers(displayed_fields_table_name)
 
-        self._dump_file.write("\n")
+        self._write("\n")
 
     def generate_all_delete_statements(self, from_table_name: str, table_to_be_exported: List[str], join_statements: str, where_filter: str=""):
         """
@@ -0,0 +1,142 @@
+# coding: utf-8
+
+# Copyright (C) 2017 Open Path View, Maison Du Libre
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Contributors: Benjamin BERNARD <benjamin.bernard@openpathview.fr>
+# Email: team@openpathview.fr
+# Description: Materialize the exported primary keys of each table (key sets) in temporary tables.
+
+import hashlib
+import io
+import logging
+import psycopg2
+from typing import List, Dict
+from pg_dump_filtered.helpers import SchemaUtils
+
+KEYS_TABLE_NAME = "pg_temp.pg_dump_filtered_keys_{table_hash}"
+
+REQ_DROP_KEYS_TABLE = "DROP TABLE IF EXISTS {keys_table_name};"
+
+REQ_CREATE_KEYS_TABLE_FROM_SELECT = """
+    CREATE TEMP TABLE {keys_table_name} AS
+    SELECT DISTINCT {select_view} FROM {from_table_name} {join_statements} {where};
+"""
+
+REQ_CREATE_EMPTY_KEYS_TABLE = "CREATE TEMP TABLE {keys_table_name} AS SELECT {pkeys} FROM {table_name} WITH NO DATA;"
+
+REQ_COPY_KEYS_TABLE_TO = "COPY {keys_table_name} TO STDOUT"
+
+REQ_COPY_KEYS_TABLE_FROM = "COPY {keys_table_name} FROM STDIN"
+
+def make_keys_table_name(table_name: str) -> str:
+    """
+    Name of the temporary table storing the key set of a table.
+    The table name is hashed so that the identifier stays under the 63 bytes Postgres limit :
+    a truncated name could be shared by two tables.
+
+    :param table_name: Schema qualified table name.
+    """
+    return KEYS_TABLE_NAME.format(table_hash=hashlib.md5(table_name.encode("utf-8")).hexdigest())
+
+class KeySetBuilder():
+    """
+    Stores the primary keys of the exported rows of each table in temporary tables,
+    so that datas can be extracted by primary key instead of evaluating the JOINs again.
+    """
+
+    def __init__(self, schema_utils: SchemaUtils, conn: psycopg2.extensions.connection):
+        """
+        Instanciate a key set builder.
+
+        :param schema_utils: Schema utils used to fetch some related schema informations.
+        :param conn: database connexion, the temporary tables belong to its session.
+        """
+        self._schema_utils = schema_utils
+        self._conn = conn
+        self.logger = logging.getLogger(__name__)
+
+    def create_key_sets(self, from_table_name: str, table_to_be_exported: List[str], join_statements: str, where_filter: str="") -> Dict[str, str]:
+        """
+        Evaluate the JOINs once per table to store the primary keys of the selected rows.
+        Tables without primary key have no key set, their rows are still extracted with the JOINs.
+
+        :param from_table_name: Table used in the FROM statement, should not be mentionned in the JOIN statements.
+        :param table_to_be_exported: Tables that will be exported.
+        :param join_statements: JOIN statements.
+        :param where_filter: SQL filters.
+        :return: Key sets (table_name => primary keys in COPY text format), to be cached.
+        """
+        where = "" if where_filter == "" or where_filter is None else " WHERE " + where_filter
+        cur = self._conn.cursor()
+        key_sets = {}
+        for tname in table_to_be_exported:
+            pkeys_cols = self._schema_utils.fetch_primary_keys(table_name=tname)
+            if pkeys_cols == []:
+                self.logger.warning("No primary key for %s, no key set created", tname)
+                continue
+
+            self.logger.debug("Creating key set for %s", tname)
+            keys_table_name = make_keys_table_name(table_name=tname)
+            cur.execute(REQ_DROP_KEYS_TABLE.format(keys_table_name=keys_table_name))
+            cur.execute(REQ_CREATE_KEYS_TABLE_FROM_SELECT.format(
+                keys_table_name=keys_table_name,
+                select_view=", ".join([c.table_name + "." + c.column_name for c in pkeys_cols]),
+                from_table_name=from_table_name,
+                join_statements=join_statements,
+                where=where))
+
+            keys = io.StringIO()
+            cur.copy_expert(REQ_COPY_KEYS_TABLE_TO.format(keys_table_name=keys_table_name), keys)
+            key_sets[tname] = keys.getvalue()
+
+        return key_sets
+
+    def load_key_sets(self, key_sets: Dict[str, str]):
+        """
+        Load cached key sets in the temporary tables.
+
+        :param key_sets: Key sets (table_name => primary keys in COPY text format).
+        """
+        cur = self._conn.cursor()
+        for tname, keys in key_sets.items():
+            self.logger.debug("Loading key set for %s", tname)
+            keys_table_name = make_keys_table_name(table_name=tname)
+            pkeys_cols = self._schema_utils.fetch_primary_keys(table_name=tname)
+            cur.execute(REQ_DROP_KEYS_TABLE.format(keys_table_name=keys_table_name))
+            cur.execute(REQ_CREATE_EMPTY_KEYS_TABLE.format(
+                keys_table_name=keys_table_name,
+                pkeys=", ".join([c.column_name for c in pkeys_cols]),
+                table_name=tname))
+            cur.copy_expert(REQ_COPY_KEYS_TABLE_FROM.format(keys_table_name=keys_table_name), io.StringIO(keys))
+
+    def has_key_set(self, table_name: str) -> bool:
+        """
+        Tells if a table has a key set, only tables with a primary key have one.
+
+        :param table_name: Exported table.
+        """
+        return self._schema_utils.fetch_primary_keys(table_name=table_name) != []
+
+    def generate_join_statement(self, table_name: str) -> str:
+        """
+        Generate the JOIN statement of a table with its key set, the key set table being used in the FROM statement.
+
+        :param table_name: Exported table.
+        :return: JOIN statement.
+        """
+        pkeys_cols = self._schema_utils.fetch_primary_keys(table_name=table_name)
+        if pkeys_cols == []:
+            raise ValueError("No key set for {}, it has no primary key".format(table_name))
+
+        return "INNER JOIN {table_name} USING ({pkeys})".format(
+            table_name=table_name, pkeys=", ".join([c.column_name for c in pkeys_cols]))
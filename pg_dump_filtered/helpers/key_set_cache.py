@@ -0,0 +1,126 @@
+# coding: utf-8
+
+# Copyright (C) 2017 Open Path View, Maison Du Libre
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Contributors: Benjamin BERNARD <benjamin.bernard@openpathview.fr>
+# Email: team@openpathview.fr
+# Description: Local file cache of the primary keys exported for each table.
+
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import List, Dict
+
+CACHE_FILE_EXTENSION = ".json"
+
+class KeySetCache():
+    """
+    Cache of the exported primary keys of each table (key sets), stored in a local directory, one file per entry.
+    Entries expire after a TTL and the least recently used ones are evicted when the cache is full.
+    """
+
+    def __init__(self, cache_dir: str, ttl: float=3600, max_entries: int=32):
+        """
+        Instanciate a key set cache.
+
+        :param cache_dir: Directory where entries are stored, created if needed.
+        :param ttl: Time to live of an entry in seconds.
+        :param max_entries: Maximum number of entries, least recently used ones are evicted.
+        """
+        self.logger = logging.getLogger(__name__)
+        self._cache_dir = cache_dir
+        self._ttl = ttl
+        self._max_entries = max_entries
+
+        os.makedirs(self._cache_dir, exist_ok=True)
+
+    def make_key(
+            self, sql_filters: str, tables: List[str], ignored_constraints: List[str], schema_fingerprint: str, from_statement: str,
+            table_filters: Dict[str, str]={}) -> str:
+        """
+        Generate the key of a cache entry.
+
+        :param sql_filters: SQL filters of the dump.
+        :param tables: Tables that will be exported.
+        :param ignored_constraints: Constraints ignored in the JOINs.
+        :param schema_fingerprint: Fingerprint of the tables schema, see SchemaUtils.fetch_schema_fingerprint.
+        :param from_statement: FROM statement of the dump (it contains the sample).
+        :param table_filters: SQL predicates applied on the scan of some tables.
+        :return: The key.
+        """
+        content = json.dumps([
+            sql_filters, sorted(tables), sorted(ignored_constraints), schema_fingerprint, from_statement, sorted(table_filters.items())])
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        """
+        Path of the file of an entry.
+        """
+        return os.path.join(self._cache_dir, key + CACHE_FILE_EXTENSION)
+
+    def get(self, key: str) -> Dict[str, str]:
+        """
+        Get the key sets of an entry.
+
+        :param key: Key of the entry.
+        :return: Key sets (table_name => primary keys in COPY text format) or None if the entry is missing or expired.
+        """
+        path = self._entry_path(key)
+        if not os.path.exists(path):
+            self.logger.debug("Key sets cache miss : %s", key)
+            return None
+
+        with open(path, 'r') as entry_file:
+            entry = json.load(entry_file)
+
+        if time.time() - entry["created"] > self._ttl:
+            self.logger.debug("Key sets cache entry expired : %s", key)
+            os.remove(path)
+            return None
+
+        os.utime(path)  # last access time is the file modification time, used for LRU eviction
+        self.logger.debug("Key sets cache hit : %s", key)
+        return entry["key_sets"]
+
+    def set(self, key: str, key_sets: Dict[str, str]):
+        """
+        Store the key sets of an entry and evict the least recently used entries if needed.
+
+        :param key: Key of the entry.
+        :param key_sets: Key sets (table_name => primary keys in COPY text format).
+        """
+        self.logger.debug("Storing key sets cache entry : %s", key)
+        path = self._entry_path(key)
+        with open(path + ".tmp", 'w') as entry_file:
+            json.dump({"created": time.time(), "key_sets": key_sets}, entry_file)
+        os.replace(path + ".tmp", path)  # readers never see a partial entry
+
+        self._evict()
+
+    def _evict(self):
+        """
+        Remove expired entries and the least recently used ones above max_entries.
+        """
+        entries = []
+        for file_name in os.listdir(self._cache_dir):
+            if file_name.endswith(CACHE_FILE_EXTENSION):
+                path = os.path.join(self._cache_dir, file_name)
+                entries.append((os.path.getmtime(path), path))
+        entries.sort(reverse=True)
+
+        for i, (last_used, path) in enumerate(entries):
+            if i >= self._max_entries or time.time() - last_used > self._ttl:
+                self.logger.debug("Evicting key sets cache entry : %s", path)
+                os.remove(path)
@@ -17,24 +17,45 @@
 # Description: Utils function to generate SQL request.
 
 import logging
+import random
 from typing import List, Dict
+from pg_dump_filtered import model
 from pg_dump_filtered.helpers import SchemaUtils
 
+SUBSTITUTE_NULL = "NULL"
+SUBSTITUTE_HASH = "md5(CAST({column} AS text))"
+
+SAMPLE_METHODS = ["SYSTEM", "BERNOULLI"]
+SAMPLE_METHOD_DEFAULT = "SYSTEM"
+
+REQ_TABLESAMPLE = "{table_name} TABLESAMPLE {method} ({percentage}) REPEATABLE ({seed})"
+
+REQ_LIMIT_SAMPLE = """{table_name} INNER JOIN (
+    SELECT {pkeys} FROM {table_name} {where} ORDER BY md5({hashed_keys} || '|{seed}') LIMIT {limit}
+) AS pg_dump_filtered_sample ON {rules}"""
+
 class RequestBuilder():
 
-    def __init__(self, schema_utils: SchemaUtils):
+    def __init__(self, schema_utils: SchemaUtils, column_substitutions: Dict[str, str]={}, table_filters: Dict[str, str]={}):
         """
         Instanciate a request builder.
 
         :param schema_utils: Schema utils used to fetch some related schema informations.
+        :param column_substitutions: SQL expressions exported instead of the columns values,
+                                     "table_name.column_name" or "schema.table_name.column_name" => expression.
+                                     "{column}" in the expression is replaced by the column, eg: SUBSTITUTE_NULL, SUBSTITUTE_HASH.
+        :param table_filters: SQL predicates applied directly on the scan of some tables, schema qualified table_name => predicate.
         """
         self._schema_utils = schema_utils
+        self._column_substitutions = column_substitutions
+        self._table_filters = table_filters
         self.logger = logging.getLogger(__name__)
 
     def generate_join_statments(self, table_names: List[str], exclude_from_statment: List[str]=[]) -> str:
         """
         Generate a general JOIN statement with all necessary JOINS for listed tables based on ther foreign_key.
         For nullable foreign_keys we use LEFT JOIN othewise INNER JOIN.
+        Table filters are added to the JOIN rules of their table, so that they are applied on its scan.
 
         :param table_names: List of tables that should be involved in the JOIN statment.
         :param exclude_from_statment: List of table that will be excluded, typically you need to exclude the table used in FROM statement.
@@ -62,11 +83,16 @@ class RequestBuilder():
                 if fk_referenced_table in exclude_from_statment:
                     continue
 
-                fk_req_rules = " AND ".join(join_rules)
-
                 # Using LEFT JOIN when the foreign key is nullable, to prevent unecessary restriction if the key is null
                 fk_join_type = "LEFT" if as_nullable_field else "INNER"
 
+                if fk_referenced_table in self._table_filters:
+                    join_rules.append("({})".format(self._table_filters[fk_referenced_table]))
+                    # rows without a matching filtered row are removed, as they would be by a WHERE filter
+                    fk_join_type = "INNER"
+
+                fk_req_rules = " AND ".join(join_rules)
+
                 fk_join_req = "{join_type} JOIN {referenced_table} ON {rules} ".format(
                     join_type=fk_join_type,
                     referenced_table=fk_referenced_table,
@@ -76,14 +102,104 @@ class RequestBuilder():
 
         return join_req
 
-    def generate_select_statement(self, from_table_name: str, displayed_fields_table_name: str, join_statements: str, where_filter: str="") -> str:
+    def generate_from_statement(self, from_table_name: str, sample: model.Sample=None) -> str:
+        """
+        Generate the FROM statement, sampling the FROM table if a sample is requested.
+        The sampled table keeps its name so the JOIN statements still apply, and the related tables are
+        only joined to the sampled rows. A limit sample is taken among the rows matching the table filter of the FROM table,
+        other filters are applied afterward and may keep fewer rows.
+
+        :param from_table_name: Table used in the FROM statement.
+        :param sample: Sample of the FROM table that will be exported, None to export all matching rows.
+        :return: FROM statement (without the FROM keyword).
+        """
+        if sample is None:
+            return from_table_name
+
+        self.logger.debug("Sampling %s with : %r", from_table_name, sample)
+
+        # The FROM statement is shared by the delete and select statements, they must all sample the same rows
+        seed = float(sample.seed) if sample.seed is not None else random.random()
+
+        if sample.percentage is not None:
+            method = (sample.method if sample.method is not None else SAMPLE_METHOD_DEFAULT).upper()
+            if method not in SAMPLE_METHODS:
+                raise ValueError("Unknown sample method {!r}, should be one of {!r}".format(sample.method, SAMPLE_METHODS))
+
+            return REQ_TABLESAMPLE.format(
+                table_name=from_table_name, method=method, percentage=float(sample.percentage), seed=seed)
+
+        if sample.limit is not None:
+            pkeys_cols = self._schema_utils.fetch_primary_keys(table_name=from_table_name)
+            if pkeys_cols == []:
+                raise ValueError("A limit sample needs a primary key, {} has none (use a percentage sample)".format(from_table_name))
+
+            pkeys = ", ".join([c.column_name for c in pkeys_cols])
+            rules = " AND ".join([
+                "{c.table_name}.{c.column_name} = pg_dump_filtered_sample.{c.column_name}".format(c=c) for c in pkeys_cols])
+
+            # Ordering by a seeded hash of the primary key gives the same rows for the same seed
+            hashed_keys = " || '|' || ".join(["CAST({cname} AS text)".format(cname=c.column_name) for c in pkeys_cols])
+
+            table_filter = self._table_filters.get(from_table_name)
+            where = "" if table_filter is None or table_filter == "" else "WHERE ({})".format(table_filter)
+
+            return REQ_LIMIT_SAMPLE.format(
+                table_name=from_table_name, pkeys=pkeys, where=where, hashed_keys=hashed_keys, seed=seed, limit=int(sample.limit),
+                rules=rules)
+
+        return from_table_name
+
+    def generate_where_filter(self, from_table_name: str, where_filter: str=None) -> str:
+        """
+        Generate the filters of the WHERE statement : the SQL filters and the table filter of the FROM table
+        (other table filters are in the JOIN statements).
+
+        :param from_table_name: Table used in the FROM statement.
+        :param where_filter: SQL filters.
+        :return: SQL filters, None if there is no filter.
+        """
+        filters = [f for f in [where_filter, self._table_filters.get(from_table_name)] if f is not None and f != ""]
+        if filters == []:
+            return None
+        if len(filters) == 1:
+            return filters[0]
+        return " AND ".join(["({})".format(f) for f in filters])
+
+    def generate_displayed_fields(self, table_name: str) -> str:
+        """
+        Generate the fields list of a select statement, fields are in the same order as SchemaUtils.fetch_exported_cols_names
+        so that they match the COPY header.
+
+        :param table_name: Table whose fields are displayed.
+        :return: Fields list.
+        """
+        if not self._column_substitutions and not self._schema_utils.has_excluded_columns():
+            return "{table_name}.*".format(table_name=table_name)
+
+        fields = []
+        for c in self._schema_utils.fetch_exported_cols_names(table_name=table_name):
+            column = "{c.table_name}.\"{c.column_name}\"".format(c=c)  # prevent uppercases columns names errors
+            substitution_keys = [k for k in self._column_substitutions if self._schema_utils.is_column_in(column=c, columns=[k])]
+            if substitution_keys != []:
+                substitution = self._column_substitutions[substitution_keys[0]].replace("{column}", column)
+                fields.append("{substitution} AS \"{cname}\"".format(substitution=substitution, cname=c.column_name))
+            else:
+                fields.append(column)
+
+        return ", ".join(fields)
+
+    def generate_select_statement(self, from_table_name: str, displayed_fields_table_name: str, join_statements: str, where_filter: str="", distinct: bool=True) -> str:
         """
         Generate a select statement.
+
+        :param distinct: Use SELECT DISTINCT, not needed when the JOINs can't duplicate rows.
         """
         where = "" if where_filter == "" or where_filter is None else " WHERE " + where_filter
 
-        req = """SELECT DISTINCT {displayed_fields_table_name}.* FROM {from_table_name} {join_statements} {where} """.format(
-            displayed_fields_table_name=displayed_fields_table_name,
+        req = """SELECT {distinct}{displayed_fields} FROM {from_table_name} {join_statements} {where} """.format(
+            distinct="DISTINCT " if distinct else "",
+            displayed_fields=self.generate_displayed_fields(table_name=displayed_fields_table_name),
             from_table_name=from_table_name,
             join_statements=join_statements,
             where=where)
@@ -95,6 +211,7 @@ class RequestBuilder():
 
         :param table_to_be_exported: Tables that will be exported.
         :param from_table_name: Table used in the FROM statement, should not be mentionned in the JOIN statements.
+                                May be a sampled FROM statement (see generate_from_statement).
         :param where_filter: SQL filters.
         :return: Dictionnary of select statement for each table (table_name => select statement)
         """
@@ -20,14 +20,16 @@ import logging
 import psycopg2
 import psycopg2.extras
 
-from typing import List
+from typing import List, Tuple
 from pg_dump_filtered import model
 
 REQ_FOREING_KEY_FOR_A_TABLE = """
     SELECT
          KCU1.CONSTRAINT_NAME AS fk_constraint_name
+        ,KCU1.TABLE_SCHEMA AS fk_table_schema
         ,KCU1.TABLE_NAME AS fk_table_name
         ,KCU1.COLUMN_NAME AS fk_column_name
+        ,KCU2.TABLE_SCHEMA AS referenced_table_schema
         ,KCU2.TABLE_NAME AS referenced_table_name
         ,KCU2.COLUMN_NAME AS referenced_column_name
     FROM INFORMATION_SCHEMA.REFERENTIAL_CONSTRAINTS AS RC
@@ -43,17 +45,18 @@ REQ_FOREING_KEY_FOR_A_TABLE = """
         AND KCU2.CONSTRAINT_NAME = RC.UNIQUE_CONSTRAINT_NAME
         AND KCU2.ORDINAL_POSITION = KCU1.ORDINAL_POSITION
 
-    WHERE KCU1.TABLE_NAME = '{table_name}';
+    WHERE KCU1.TABLE_SCHEMA = '{table_schema}' AND KCU1.TABLE_NAME = '{table_name}';
     """
 
 REQ_IS_NULLABLE = """
     SELECT is_nullable
     FROM information_schema.columns
-    WHERE table_name = '{table_name}' AND column_name = '{column_name}';
+    WHERE table_schema = '{table_schema}' AND table_name = '{table_name}' AND column_name = '{column_name}';
 """
 
 REQ_FETCH_COLULMNS = """
-    SELECT COLUMN_NAME FROM information_schema.columns WHERE table_name = '{table_name}' ORDER BY ORDINAL_POSITION;
+    SELECT COLUMN_NAME FROM information_schema.columns
+    WHERE table_schema = '{table_schema}' AND table_name = '{table_name}' ORDER BY ORDINAL_POSITION;
 """
 
 REQ_FETCH_TABLE_PRIMARY_KEYS = """
@@ -65,7 +68,36 @@ WHERE
     tc.constraint_type = 'PRIMARY KEY'
     and kc.table_name = tc.table_name and kc.table_schema = tc.table_schema
     and kc.constraint_name = tc.constraint_name
-    and kc.table_name = '{table_name}';
+    and kc.table_schema = '{table_schema}' and kc.table_name = '{table_name}';
+"""
+
+REQ_SCHEMA_FINGERPRINT = """
+    SELECT md5(string_agg(definition, ',' ORDER BY definition)) AS fingerprint
+    FROM (
+        SELECT table_schema || '.' || table_name || '.' || column_name || ':' || data_type || ':' || is_nullable AS definition
+        FROM information_schema.columns WHERE (table_schema, table_name) IN ({table_names})
+        UNION ALL
+        SELECT table_schema || '.' || table_name || '.' || constraint_name || ':' || constraint_type AS definition
+        FROM information_schema.table_constraints WHERE (table_schema, table_name) IN ({table_names})
+    ) AS definitions;
+"""
+
+REQ_FIND_TABLE_SCHEMAS = """
+    SELECT table_schema FROM information_schema.tables
+    WHERE table_name = '{table_name}' AND table_schema IN ({schemas});
+"""
+
+REQ_FETCH_SECONDARY_INDEXES = """
+    SELECT pg_catalog.quote_ident(i.schemaname) || '.' || pg_catalog.quote_ident(i.indexname) AS index_name,
+        pg_catalog.pg_get_indexdef(c.oid) AS definition
+    FROM pg_catalog.pg_indexes i
+    INNER JOIN pg_catalog.pg_namespace n ON n.nspname = i.schemaname
+    INNER JOIN pg_catalog.pg_class c ON c.relname = i.indexname AND c.relnamespace = n.oid
+    INNER JOIN pg_catalog.pg_index ix ON ix.indexrelid = c.oid
+    WHERE i.schemaname = '{table_schema}' AND i.tablename = '{table_name}'
+    AND NOT ix.indisunique
+    AND NOT EXISTS (SELECT 1 FROM pg_catalog.pg_constraint con WHERE con.conindid = c.oid)
+    ORDER BY i.indexname;
 """
 
 class SchemaUtils():
@@ -73,20 +105,75 @@ class SchemaUtils():
     Helps you extract informations from information_schema database.
     """
 
-    def __init__(self, conn: psycopg2.extensions.connection, ignored_constraints: List[str]=[]):
+    def __init__(
+            self,
+            conn: psycopg2.extensions.connection,
+            ignored_constraints: List[str]=[],
+            excluded_columns: List[str]=[],
+            schemas: List[str]=["public"]):
         """
         Intanciate a SchemaUtils class.
+        Tables are identified by their schema qualified name ("schema.table"), catalog requests are restricted to their schema.
 
         :param conn: The psycog connexion.
+        :param ignored_constraints: Constraints names that will be ignored.
+        :param excluded_columns: Columns that won't be exported, as "table_name.column_name" or "schema.table_name.column_name".
+        :param schemas: Schemas where unqualified table names are searched, in order.
         """
         self.logger = logging.getLogger(__name__)
 
         self.logger.debug("Instanciating utils with conn : %r", conn)
         self.conn = conn
         self._ignored_constraints = ignored_constraints
+        self._excluded_columns = excluded_columns
+        self._schemas = schemas
         self._fk_cache = {}  # cache of foreign keys "tablename": Dict[str, model.ForeignKey]
         self._is_nullable_cache = {}  # cache of is_nullable request, "table_name.columname" -> bool
 
+    def split_table_name(self, table_name: str) -> Tuple[str, str]:
+        """
+        Split a schema qualified table name.
+
+        :param table_name: Table name, as "schema.table".
+        :return: A tuple (schema, table).
+        """
+        if "." not in table_name:
+            return (self._schemas[0], table_name)
+        table_schema, table_short_name = table_name.split(".", 1)
+        return (table_schema, table_short_name)
+
+    def qualify_table_name(self, table_name: str) -> str:
+        """
+        Qualify a table name with its schema, unqualified names are searched in the schemas, in order.
+
+        :param table_name: Table name, qualified or not.
+        :return: Qualified table name "schema.table".
+        """
+        if "." in table_name:
+            return table_name
+
+        cur = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(REQ_FIND_TABLE_SCHEMAS.format(table_name=table_name, schemas=", ".join(["'{}'".format(s) for s in self._schemas])))
+        found_schemas = [row["table_schema"] for row in cur]
+
+        for schema in self._schemas:
+            if schema in found_schemas:
+                return schema + "." + table_name
+
+        raise ValueError("Table {!r} not found in schemas {!r}".format(table_name, self._schemas))
+
+    def is_column_in(self, column: model.ColumnRef, columns: List[str]) -> bool:
+        """
+        Return true if a column is in a list of "schema.table_name.column_name" or "table_name.column_name".
+
+        :param column: The column.
+        :param columns: List of columns.
+        """
+        table_short_name = self.split_table_name(table_name=column.table_name)[1]
+        return (
+            "{c.table_name}.{c.column_name}".format(c=column) in columns or
+            "{table_name}.{c.column_name}".format(table_name=table_short_name, c=column) in columns)
+
     def _map_foreign_key_to_model(self, db_row: List[str]):
         """
         Map a foreign key.
@@ -98,10 +185,10 @@ class SchemaUtils():
         match_cols.append(
             model.ColumnConstraint(
                 foreign_col=model.ColumnRef(
-                    table_name=db_row['fk_table_name'],
+                    table_name=db_row['fk_table_schema'] + "." + db_row['fk_table_name'],
                     column_name=db_row['fk_column_name']),
                 referenced_col=model.ColumnRef(
-                    table_name=db_row['referenced_table_name'],
+                    table_name=db_row['referenced_table_schema'] + "." + db_row['referenced_table_name'],
                     column_name=db_row['referenced_column_name'])
             )
         )
@@ -122,7 +209,8 @@ class SchemaUtils():
 
         constraints = {}
         cur = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute(REQ_FOREING_KEY_FOR_A_TABLE.format(table_name=table_name))
+        table_schema, table_short_name = self.split_table_name(table_name=table_name)
+        cur.execute(REQ_FOREING_KEY_FOR_A_TABLE.format(table_schema=table_schema, table_name=table_short_name))
 
         for row in cur:
             fk = self._map_foreign_key_to_model(row)
@@ -151,7 +239,8 @@ class SchemaUtils():
         keys = []
 
         cur = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute(REQ_FETCH_TABLE_PRIMARY_KEYS.format(table_name=table_name))
+        table_schema, table_short_name = self.split_table_name(table_name=table_name)
+        cur.execute(REQ_FETCH_TABLE_PRIMARY_KEYS.format(table_schema=table_schema, table_name=table_short_name))
 
         for row in cur:
             if "column_name" in row:
@@ -206,7 +295,8 @@ class SchemaUtils():
             return self._is_nullable_cache[key]
 
         cur = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute(REQ_IS_NULLABLE.format(table_name=column.table_name, column_name=column.column_name))
+        table_schema, table_short_name = self.split_table_name(table_name=column.table_name)
+        cur.execute(REQ_IS_NULLABLE.format(table_schema=table_schema, table_name=table_short_name, column_name=column.column_name))
         for row in cur:
             nullable = row['is_nullable'] == "YES"
             self._is_nullable_cache[key] = nullable
@@ -223,7 +313,8 @@ class SchemaUtils():
         cols = []
 
         cur = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute(REQ_FETCH_COLULMNS.format(table_name=table_name))
+        table_schema, table_short_name = self.split_table_name(table_name=table_name)
+        cur.execute(REQ_FETCH_COLULMNS.format(table_schema=table_schema, table_name=table_short_name))
 
         for row in cur:
             if "column_name" in row:
@@ -231,3 +322,52 @@ class SchemaUtils():
 
         self.logger.debug("Found cols : %r", cols)
         return cols
+
+    def fetch_exported_cols_names(self, table_name: str) -> List[model.ColumnRef]:
+        """
+        Gets table columns that will be exported (excluded columns are removed) in ORDINAL_POSITION order.
+
+        :param table_name: Table where columns names will be extracted.
+        :return: The list of columnsRef.
+        """
+        cols = self.fetch_cols_names(table_name=table_name)
+        return [c for c in cols if not self.is_column_in(column=c, columns=self._excluded_columns)]
+
+    def has_excluded_columns(self) -> bool:
+        """
+        Return true if some columns won't be exported.
+        """
+        return len(self._excluded_columns) > 0
+
+    def fetch_schema_fingerprint(self, table_names: List[str]) -> str:
+        """
+        Compute a fingerprint of the tables schema (columns and constraints), it changes when the schema of one of the tables changes.
+
+        :param table_names: Tables included in the fingerprint.
+        :return: Fingerprint of the tables schema.
+        """
+        self.logger.debug("fetch_schema_fingerprint for tables %r", table_names)
+        cur = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(REQ_SCHEMA_FINGERPRINT.format(
+            table_names=", ".join(["('{}', '{}')".format(*self.split_table_name(table_name=t)) for t in table_names])))
+        fingerprint = cur.fetchone()["fingerprint"]
+
+        self.logger.debug("Schema fingerprint : %s", fingerprint)
+        return fingerprint
+
+    def fetch_secondary_indexes(self, table_name: str) -> List[model.Index]:
+        """
+        Fetch the non unique indexes of a table that don't back a constraint (primary key, unique, exclusion constraints
+        and unique indexes are left out).
+
+        :param table_name: Table name.
+        :return: List of indexes.
+        """
+        self.logger.debug("fetch_secondary_indexes for table %s", table_name)
+        cur = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        table_schema, table_short_name = self.split_table_name(table_name=table_name)
+        cur.execute(REQ_FETCH_SECONDARY_INDEXES.format(table_schema=table_schema, table_name=table_short_name))
+
+        return [
+            model.Index(index_name=row["index_name"], table_name=table_name, definition=row["definition"])
+            for row in cur]
@@ -0,0 +1,160 @@
+# coding: utf-8
+
+# Copyright (C) 2017 Open Path View, Maison Du Libre
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Contributors: Benjamin BERNARD <benjamin.bernard@openpathview.fr>
+# Email: team@openpathview.fr
+# Description: Session settings of the dump connexions and replica checks.
+
+import logging
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+from typing import Dict
+
+from pg_dump_filtered import model
+
+SESSION_PROFILES = {
+    "default": model.SessionProfile(settings={}, read_only=False, deferrable=False),
+    # Big sorts and hashes of the SELECT DISTINCT stay in memory, parallel plans are allowed
+    "bulk": model.SessionProfile(
+        settings={
+            "work_mem": "256MB",
+            "max_parallel_workers_per_gather": "4",
+            "statement_timeout": "0"},
+        read_only=False,
+        deferrable=False),
+    # Same as bulk, in a read only transaction waiting for a snapshot that can't be affected by concurrent transactions
+    "bulk-snapshot": model.SessionProfile(
+        settings={
+            "work_mem": "256MB",
+            "max_parallel_workers_per_gather": "4",
+            "statement_timeout": "0"},
+        read_only=True,
+        deferrable=True),
+}
+
+REQ_SET_CONFIG = "SELECT pg_catalog.set_config(%s, %s, false);"
+
+REQ_EXPORT_SNAPSHOT = "SELECT pg_catalog.pg_export_snapshot() AS snapshot;"
+
+REQ_IMPORT_SNAPSHOT = "SET TRANSACTION SNAPSHOT %s;"
+
+REQ_IS_IN_RECOVERY = "SELECT pg_is_in_recovery() AS in_recovery;"
+
+REQ_REPLICA_LAG = """
+    SELECT
+        pg_is_in_recovery() AS in_recovery,
+        CASE
+            WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+        END AS lag;
+"""
+
+class SessionUtils():
+    """
+    Helps you set up the dump connexions.
+    """
+
+    def __init__(self, conn: psycopg2.extensions.connection):
+        """
+        Instanciate a SessionUtils class.
+
+        :param conn: The psycog connexion.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.conn = conn
+
+    def apply_profile(self, profile: model.SessionProfile):
+        """
+        Apply a session profile, should be called before any request on the connexion.
+        Standbys can't run SERIALIZABLE transactions, a deferrable profile then uses a REPEATABLE READ READ ONLY transaction.
+
+        :param profile: The session profile.
+        """
+        self.logger.debug("Applying session profile : %r", profile)
+        if profile.deferrable and self.is_standby():
+            self.logger.warning("SERIALIZABLE transactions can't be used on a standby, using a REPEATABLE READ READ ONLY transaction")
+            self.conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+        elif profile.deferrable:
+            self.conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_SERIALIZABLE, readonly=True, deferrable=True)
+        elif profile.read_only:
+            self.conn.set_session(readonly=True)
+
+        self.apply_settings(settings=profile.settings)
+
+    def apply_settings(self, settings: Dict[str, str]):
+        """
+        Apply session settings, they are kept for the whole session once the transaction is committed.
+
+        :param settings: Settings, name => value.
+        """
+        cur = self.conn.cursor()
+        for name, value in settings.items():
+            cur.execute(REQ_SET_CONFIG, (name, value))
+
+    def export_snapshot(self) -> str:
+        """
+        Export a snapshot of the current transaction, so that other sessions see the same datas. It can be imported
+        until the transaction ends. In REPEATABLE READ and SERIALIZABLE it's the transaction snapshot, in READ COMMITTED
+        it's the snapshot of the export request (following requests of this session get their own snapshots).
+
+        :return: Snapshot identifier.
+        """
+        cur = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(REQ_EXPORT_SNAPSHOT)
+        snapshot = cur.fetchone()["snapshot"]
+        self.logger.debug("Exported snapshot : %s", snapshot)
+        return snapshot
+
+    def import_snapshot(self, snapshot: str, profile: model.SessionProfile):
+        """
+        Start a transaction using an exported snapshot, should be called before any request on the connexion.
+        As for pg_dump workers the transaction is REPEATABLE READ READ ONLY whatever the profile isolation
+        (a READ ONLY DEFERRABLE transaction can't import a snapshot), only the settings of the profile are applied.
+
+        :param snapshot: Snapshot identifier, see export_snapshot.
+        :param profile: Session profile whose settings are applied.
+        """
+        self.logger.debug("Importing snapshot : %s", snapshot)
+        self.conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True, deferrable=False)
+        self.apply_settings(settings=profile.settings)
+        self.conn.commit()  # the snapshot must be imported by the first request of a transaction, settings are kept
+        self.conn.cursor().execute(REQ_IMPORT_SNAPSHOT, (snapshot,))
+
+    def is_standby(self) -> bool:
+        """
+        Return true if the database is a standby (in recovery). The transaction of the request is rolled back,
+        so that the session can still be set up.
+        """
+        cur = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(REQ_IS_IN_RECOVERY)
+        in_recovery = cur.fetchone()["in_recovery"]
+        self.conn.rollback()
+        return in_recovery
+
+    def fetch_replica_lag(self) -> float:
+        """
+        Fetch the replication lag of a standby.
+
+        :return: Lag in seconds, 0 if the database isn't a standby or has replayed everything it received.
+        """
+        cur = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(REQ_REPLICA_LAG)
+        row = cur.fetchone()
+
+        if not row["in_recovery"]:
+            self.logger.warning("Replica database isn't in recovery, it's not a standby")
+
+        self.logger.debug("Replica lag : %s", row["lag"])
+        return float(row["lag"])
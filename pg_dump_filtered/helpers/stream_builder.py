@@ -0,0 +1,282 @@
+# coding: utf-8
+
+# Copyright (C) 2017 Open Path View, Maison Du Libre
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Contributors: Benjamin BERNARD <benjamin.bernard@openpathview.fr>
+# Email: team@openpathview.fr
+# Description: Stream a dump directly into a target database, without intermediate dump file.
+
+import queue
+import psycopg2
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+from pg_dump_filtered.helpers import SchemaUtils
+from pg_dump_filtered.helpers.dump_builder import DumpBuilder, RESTORE_MODE_DELETE, REQ_SELECT_DUMP
+from pg_dump_filtered import model
+from pg_dump_filtered.helpers.budget_tracker import BudgetTracker
+from pg_dump_filtered.helpers.column_tap import ColumnTap
+
+PIPE_MAX_CHUNKS = 64  # Chunks buffered between the source COPY and the target COPY
+PIPE_PUT_TIMEOUT = 0.1  # Seconds, the writer checks if the reader aborted at this interval
+
+STATEMENTS_BATCH_SIZE = 1024 * 1024  # Pending statements are executed on the target once they reach this size (in characters)
+
+class CopyPipe():
+    """
+    Bounded in-memory buffer between a COPY ... TO STDOUT (writer) and a COPY ... FROM STDIN (reader).
+    The writer blocks when the buffer is full, so memory usage doesn't depend on the table size.
+    """
+
+    def __init__(self, max_chunks: int=PIPE_MAX_CHUNKS):
+        """
+        Instanciate a pipe.
+
+        :param max_chunks: Number of chunks buffered before the writer blocks.
+        """
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._aborted = False
+        self._error = None
+
+    def _put(self, chunk):
+        """
+        Put a chunk in the buffer, waiting for some space, fails if the reader aborted.
+
+        :param chunk: Chunk of COPY datas, None marks the end of the datas.
+        """
+        while True:
+            if self._aborted:
+                raise IOError("COPY pipe reader aborted")
+            try:
+                self._queue.put(chunk, timeout=PIPE_PUT_TIMEOUT)
+                return
+            except queue.Full:
+                continue
+
+    def write(self, data):
+        """
+        Write side, used by the source COPY ... TO STDOUT.
+        """
+        self._put(data)
+
+    def close(self, error: Exception=None):
+        """
+        Mark the end of the datas.
+
+        :param error: Error of the writer, the reader will fail with it.
+        """
+        if self._aborted:   # nobody is reading anymore
+            return
+        self._error = error
+        self._put(None)
+
+    def read(self, size: int=-1):
+        """
+        Read side, used by the target COPY ... FROM STDIN.
+        """
+        chunk = self._queue.get()
+        if chunk is None:
+            self._queue.put(None)  # following reads also get the end of the datas
+            if self._error is not None:
+                raise IOError("COPY pipe writer failed : {}".format(self._error))
+            return b""
+        return chunk
+
+    def abort(self):
+        """
+        Abort the reader, the writer will fail on its next write.
+        """
+        self._aborted = True
+
+class StreamBuilder(DumpBuilder):
+    """
+    Dump builder executing the dump statements on a target database instead of writing them to a file,
+    each table COPY output is piped into a COPY FROM STDIN on the target connection.
+    """
+
+    def __init__(
+            self,
+            schema_utils: SchemaUtils,
+            conn: psycopg2.extensions.connection,
+            target_conn: psycopg2.extensions.connection,
+            restore_mode: str=RESTORE_MODE_DELETE,
+            budget_tracker: BudgetTracker=None,
+            column_taps: Dict[str, Dict[str, ColumnTap]]=None,
+            jobs: int=1,
+            delete_budget_tracker: BudgetTracker=None,
+            connect: Callable[[], Tuple[psycopg2.extensions.connection, psycopg2.extensions.connection]]=None,
+            connect_target: Callable[[], psycopg2.extensions.connection]=None):
+        """
+        Instanciate a stream builder.
+
+        :param schema_utils: Schema utils used to fetch some related schema informations.
+        :param conn: Source database connexion.
+        :param target_conn: Target database connexion, statements are executed in its transaction.
+        :param restore_mode: How the dump will update the restored tables, RESTORE_MODE_DELETE or RESTORE_MODE_UPSERT.
+        :param budget_tracker: Enforce rows and bytes budgets on the COPY datas, None for no limit.
+        :param column_taps: Callbacks or generators receiving the values of some columns while they are dumped,
+                            table_name => {column_name => tap}. With jobs > 1 they are called from several threads.
+        :param jobs: Number of tables streamed in parallel.
+        :param delete_budget_tracker: Enforce rows and bytes budgets on the delete statements, None for no limit.
+        :param connect: Create a new (source connexion, target connexion) couple, needed to stream tables in parallel.
+        :param connect_target: Create a new target connexion, needed to create indexes in parallel.
+        """
+        self._target_conn = target_conn
+        self._pending_statements = []
+        self._pending_size = 0
+        self._jobs = jobs
+        self._connect = connect
+        self._connect_target = connect_target
+        super().__init__(schema_utils=schema_utils, conn=conn, dump_file=None, restore_mode=restore_mode, budget_tracker=budget_tracker,
+            column_taps=column_taps, delete_budget_tracker=delete_budget_tracker)
+
+    def _write(self, statements: str):
+        """
+        Queue SQL statements, they are executed on the target by batches.
+
+        :param statements: SQL statements.
+        """
+        self._pending_statements.append(statements)
+        self._pending_size += len(statements)
+        if self._pending_size >= STATEMENTS_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        Execute all queued statements on the target.
+        """
+        statements = "".join(self._pending_statements)
+        self._pending_statements = []
+        self._pending_size = 0
+
+        # only comments or blank lines, nothing to execute
+        if all(l.strip() == "" or l.strip().startswith("--") for l in statements.splitlines()):
+            return
+
+        self._target_conn.cursor().execute(statements)
+
+    def commit(self):
+        """
+        Execute all queued statements and commit the target transaction.
+        """
+        self.flush()
+        self._target_conn.commit()
+
+    def _copy_data(self, table_name: str, cols: List[model.ColumnRef], copy_from_statement: str, select_request: str):
+        """
+        Pipe the selected datas from the source to the target database.
+
+        :param table_name: Table being dumped.
+        :param cols: Dumped columns.
+        :param copy_from_statement: COPY ... FROM stdin statement the datas are restored with.
+        :param select_request: Select request, which request the table's data.
+        """
+        self.flush()
+        pipe = CopyPipe()
+        destination = self._data_destination(table_name=table_name, cols=cols, destination=pipe)
+
+        def copy_out():
+            error = None
+            try:
+                self._conn.cursor().copy_expert(REQ_SELECT_DUMP.format(select=select_request), destination)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                pipe.close(error=error)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            copy_out_future = executor.submit(copy_out)
+            try:
+                self._target_conn.cursor().copy_expert(copy_from_statement, pipe)
+            except Exception:
+                pipe.abort()
+                raise
+            copy_out_future.result()
+
+    def _dump_in_new_session(self, table_name: str, select_request: str):
+        """
+        Stream a table using its own source and target connexions.
+
+        :param table_name: Table that will be dumped.
+        :param select_request: Select request, which request the table's data.
+        """
+        conn, target_conn = self._connect()
+        try:
+            builder = StreamBuilder(
+                schema_utils=self._schema_utils, conn=conn, target_conn=target_conn, restore_mode=self._restore_mode,
+                budget_tracker=self._budget_tracker, column_taps=self._column_taps)
+            builder.dump(table_name=table_name, select_request=select_request)
+            builder.commit()
+        finally:
+            conn.close()
+            target_conn.close()
+
+    def _create_index_in_new_session(self, index: model.Index):
+        """
+        Create an index using its own target connexion.
+
+        :param index: Index to be created.
+        """
+        target_conn = self._connect_target()
+        try:
+            target_conn.cursor().execute(index.definition)
+            target_conn.commit()
+        finally:
+            target_conn.close()
+
+    def create_indexes(self, indexes: List[model.Index]):
+        """
+        Create indexes back on the target. When jobs > 1 indexes are created in parallel sessions,
+        statements already queued are committed first.
+
+        :param indexes: Indexes dropped by drop_indexes.
+        """
+        if self._jobs <= 1 or self._connect_target is None:
+            super().create_indexes(indexes=indexes)
+            return
+
+        self.logger.debug("Creating indexes with %d jobs : %r", self._jobs, [index.index_name for index in indexes])
+        self.commit()
+
+        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            futures = [executor.submit(self._create_index_in_new_session, index=index) for index in indexes]
+            for future in futures:
+                future.result()
+
+    def dump_tables(self, select_requests: Dict[str, str]):
+        """
+        Stream all data corresponding to select requests for each table_name.
+        When jobs > 1 tables are streamed in parallel sessions, statements already queued (DELETE statements ...)
+        are committed first as each session commits its own table. If a table fails, tables not started yet are skipped
+        but the committed ones stay.
+
+        :param select_requests: Dictionnary associating table_name => select request.
+        """
+        if self._jobs <= 1 or self._connect is None:
+            super().dump_tables(select_requests=select_requests)
+            return
+
+        self.logger.debug("Streaming mutiple tables with %d jobs : %r", self._jobs, select_requests.keys())
+        self.commit()
+
+        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            futures = [
+                executor.submit(self._dump_in_new_session, table_name=table_name, select_request=select)
+                for table_name, select in select_requests.items()]
+            try:
+                for future in futures:
+                    future.result()
+            except Exception:
+                for future in futures:
+                    future.cancel()  # tables that aren't streamed yet are skipped, running sessions finish
+                raise
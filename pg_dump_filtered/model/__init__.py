@@ -15,3 +15,7 @@
 from pg_dump_filtered.model.column_ref import ColumnRef
 from pg_dump_filtered.model.column_constraint import ColumnConstraint
 from pg_dump_filtered.model.foreign_key import ForeignKey
+from pg_dump_filtered.model.sample import Sample
+from pg_dump_filtered.model.session_profile import SessionProfile
+from pg_dump_filtered.model.budget import Budget
+from pg_dump_filtered.model.index import Index
@@ -0,0 +1,27 @@
+# coding: utf-8
+
+# Copyright (C) 2017 Open Path View, Maison Du Libre
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Contributors: Benjamin BERNARD <benjamin.bernard@openpathview.fr>
+# Email: team@openpathview.fr
+# Description: Represent the maximum amount of datas that can be exported.
+
+from typing import NamedTuple
+
+Budget = NamedTuple(
+    'Budget',
+    [
+        ('max_rows', int),  # Maximum number of rows, None for no limit
+        ('max_bytes', int)  # Maximum size of the COPY datas in bytes, None for no limit
+    ]
+)
@@ -0,0 +1,28 @@
+# coding: utf-8
+
+# Copyright (C) 2017 Open Path View, Maison Du Libre
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Contributors: Benjamin BERNARD <benjamin.bernard@openpathview.fr>
+# Email: team@openpathview.fr
+# Description: Represent an index of a table.
+
+from typing import NamedTuple
+
+Index = NamedTuple(
+    'Index',
+    [
+        ('index_name', str),  # Schema qualified and quoted index name
+        ('table_name', str),  # Schema qualified table name
+        ('definition', str)  # CREATE INDEX statement, as returned by pg_get_indexdef
+    ]
+)
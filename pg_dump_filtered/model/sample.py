@@ -0,0 +1,29 @@
+# coding: utf-8
+
+# Copyright (C) 2017 Open Path View, Maison Du Libre
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Contributors: Benjamin BERNARD <benjamin.bernard@openpathview.fr>
+# Email: team@openpathview.fr
+# Description: Represent a sampling of the table used in the FROM statement.
+
+from typing import NamedTuple
+
+Sample = NamedTuple(
+    'Sample',
+    [
+        ('method', str),        # TABLESAMPLE method (SYSTEM or BERNOULLI), used with percentage, None for SYSTEM
+        ('percentage', float),  # Percentage of rows to keep, None to use limit instead
+        ('limit', int),         # Number of rows to keep, None to use percentage instead
+        ('seed', float)         # Seed making the sample repeatable, None for a random sample
+    ]
+)
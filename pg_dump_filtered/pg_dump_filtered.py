@@ -16,12 +16,29 @@
 # Contributors: Benjamin BERNARD <benjamin.bernard@openpathview.fr>
 # Email: team@openpathview.fr
 # Description: PG filtered dump export service.
+import functools
 import logging
+import os
+import shutil
+import tempfile
+import threading
 import psycopg2
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
-from typing import List, Tuple
+from typing import List, Tuple, Dict, TextIO
 
-from pg_dump_filtered.helpers import SchemaUtils, RequestBuilder, DumpBuilder
+from pg_dump_filtered import model
+from pg_dump_filtered.helpers import SchemaUtils, RequestBuilder, DumpBuilder, StreamBuilder, KeySetCache, KeySetBuilder
+from pg_dump_filtered.helpers.dump_builder import RESTORE_MODE_DELETE
+from pg_dump_filtered.helpers.key_set_builder import make_keys_table_name
+from pg_dump_filtered.helpers.session_utils import SessionUtils, SESSION_PROFILES
+from pg_dump_filtered.helpers.budget_tracker import BudgetTracker
+from pg_dump_filtered.helpers.column_tap import ColumnTap
+
+FAILED_DUMP_SUFFIX = ".failed"
+DP_FAILED = """
+-- DUMP FAILED, this dump is incomplete and must not be restored : {reason}
+"""
 
 class PgDumpFiltered():
     """
@@ -34,7 +51,24 @@ class PgDumpFiltered():
             db_conn: psycopg2.extensions.connection=None,
             ignored_constraints: List[str]=[],
             sql_filters: str=None,
-            dump_file_path: str="dump.sql"):
+            table_filters: Dict[str, str]={},
+            dump_file_path: str="dump.sql",
+            sample: model.Sample=None,
+            excluded_columns: List[str]=[],
+            column_substitutions: Dict[str, str]={},
+            restore_mode: str=RESTORE_MODE_DELETE,
+            target_uri: str=None,
+            target_conn: psycopg2.extensions.connection=None,
+            jobs: int=1,
+            key_set_cache: KeySetCache=None,
+            session_profile: model.SessionProfile=SESSION_PROFILES["default"],
+            replica_uri: str=None,
+            max_replica_lag: float=None,
+            table_budget: model.Budget=None,
+            total_budget: model.Budget=None,
+            schemas: List[str]=["public"],
+            fast_load: bool=False,
+            pipeline: bool=False):
         """
         Initiate a dump filtered export service with a database.
 
@@ -42,18 +76,58 @@ class PgDumpFiltered():
         :param db_conn: psycopg2 connexion.
         :param ignored_constraints: Constraints names that should be ignored, this property can  be set after initialisation also.
         :param sql_filters: SQL filter chain, this property can  be set after initialisation also.
+        :param table_filters: SQL predicates applied on the scan of some tables instead of the whole JOIN, table_name => predicate,
+                              this property can be set after initialisation also.
         :param dump_file_path: Path of the dump file (data will be written there). Default: dump.sql
+        :param sample: Only export a sample of the FROM table (and all related datas), this property can be set after initialisation also.
+        :param excluded_columns: Columns that won't be exported, as "table_name.column_name", this property can be set after initialisation also.
+        :param column_substitutions: SQL expressions exported instead of some columns, "table_name.column_name" => expression,
+                                     this property can be set after initialisation also.
+        :param restore_mode: How the dump will update the restored tables : RESTORE_MODE_DELETE deletes rows and copy them back,
+                             RESTORE_MODE_UPSERT copy them in staging tables and merge the changed rows. Default: RESTORE_MODE_DELETE
+        :param target_uri: Target database URI, when set (or target_conn) the dump is streamed into the target database instead of the dump file.
+        :param target_conn: Target psycopg2 connexion.
+        :param jobs: Number of tables streamed in parallel into the target database, needs db_uri and target_uri. Default: 1
+        :param key_set_cache: Cache of the exported primary keys of each table, on a hit the JOINs aren't evaluated.
+                              Tables are then streamed sequentially as the key sets are stored in temporary tables of the session.
+        :param session_profile: Settings applied to the dump connexions (see session_utils.SESSION_PROFILES). Default: no settings.
+        :param replica_uri: Standby database URI, when set catalog discovery and datas extraction are made on this database.
+        :param max_replica_lag: Maximum replication lag of the standby in seconds, above it the dump is made on the primary database.
+        :param table_budget: Maximum rows and bytes exported for each table, the dump fails (and the request is cancelled) above it.
+        :param total_budget: Maximum rows and bytes exported for the whole dump, the dump fails (and the request is cancelled) above it.
+        :param schemas: Schemas where unqualified table names are searched, in order. Tables can also be given as "schema.table". Default: public
+        :param fast_load: Secondary indexes of the exported tables are dropped before the datas are loaded, created back afterward
+                          (in parallel sessions when streaming with jobs > 1) and the loaded tables are analyzed. Default: False
+        :param pipeline: Generate the delete statements on a second source connexion while the datas are dumped, needs db_uri.
+                         Only used when writing a dump file in RESTORE_MODE_DELETE without key_set_cache. Default: False
         """
         self.logger = logging.getLogger(__name__)
 
-        self._db_conn = db_conn if db_conn is not None else self._make_db_con_from_uri(db_uri=db_uri)
+        self._session_profile = session_profile
+        self._db_uri = db_uri
+        self._replica_used = False  # set when the datas are extracted from the standby
+        self._db_conn = self._connect_source(db_uri=db_uri, db_conn=db_conn, replica_uri=replica_uri, max_replica_lag=max_replica_lag)
+        self._target_uri = target_uri
+        self._target_conn = target_conn if target_conn is not None or target_uri is None else self._make_db_con_from_uri(db_uri=target_uri)
+        self.jobs = jobs
+        self.key_set_cache = key_set_cache
+        self.table_budget = table_budget
+        self.total_budget = total_budget
+        self.fast_load = fast_load
+        self.pipeline = pipeline
         self._sql_filters = sql_filters
+        self._table_filters = table_filters
         self._ignored_constraints = ignored_constraints
+        self._sample = sample
+        self._excluded_columns = excluded_columns
+        self._schemas = schemas
+        self._column_substitutions = column_substitutions
         self.dump_file_path = dump_file_path
+        self.restore_mode = restore_mode
 
         # helpers
         self._request_builder = None  # Lazy instanciation
-        self.schema_utils = SchemaUtils(conn=self._db_conn, ignored_constraints=self.ignored_constraints)
+        self.schema_utils = self._make_schema_utils()
 
         # values from helpers
         self._join_req = None   # JOINS of the requests
@@ -72,7 +146,39 @@ class PgDumpFiltered():
             database=db_uri_parsed.path[1:],
             user=db_uri_parsed.username,
             password=db_uri_parsed.password,
-            host=db_uri_parsed.hostname)
+            host=db_uri_parsed.hostname,
+            port=db_uri_parsed.port)
+
+    def _connect_source(
+            self, db_uri: str, db_conn: psycopg2.extensions.connection, replica_uri: str, max_replica_lag: float) -> psycopg2.extensions.connection:
+        """
+        Create the source connexion, on the standby database if there is one and it's not lagging too much,
+        and apply the session profile.
+
+        :param db_uri: Primary database URI, not needed if db_conn is provided.
+        :param db_conn: Primary database connexion.
+        :param replica_uri: Standby database URI.
+        :param max_replica_lag: Maximum replication lag of the standby in seconds, None for no limit.
+        :return: Psycopg2 connexion.
+        """
+        if replica_uri is not None:
+            replica_conn = self._make_db_con_from_uri(db_uri=replica_uri)
+            lag = SessionUtils(conn=replica_conn).fetch_replica_lag()
+            replica_conn.rollback()  # session profile must be applied outside a transaction
+
+            if max_replica_lag is None or lag <= max_replica_lag:
+                self.logger.debug("Dumping from the replica, lag is %ss", lag)
+                self._db_uri = replica_uri  # parallel sessions also use the replica
+                self._replica_used = True
+                SessionUtils(conn=replica_conn).apply_profile(profile=self._session_profile)
+                return replica_conn
+
+            self.logger.warning("Replica lag is %ss (maximum %ss), dumping from the primary database", lag, max_replica_lag)
+            replica_conn.close()
+
+        conn = db_conn if db_conn is not None else self._make_db_con_from_uri(db_uri=db_uri)
+        SessionUtils(conn=conn).apply_profile(profile=self._session_profile)
+        return conn
 
     @property
     def sql_filters(self) -> str:
@@ -91,6 +197,44 @@ class PgDumpFiltered():
         self.logger.debug("Filters that will be applied on resquest are : %s", sql_filters)
         self._sql_filters = sql_filters
 
+    @property
+    def table_filters(self) -> Dict[str, str]:
+        """
+        SQL predicates applied on the scan of some tables, table_name => predicate.
+        They are added to the JOIN rules of their table (the JOIN becomes an INNER JOIN),
+        or to the WHERE statement for the FROM table.
+        """
+        return self._table_filters
+
+    @table_filters.setter
+    def table_filters(self, table_filters: Dict[str, str]):
+        """
+        Set table_filters, these predicates will be applied on the scan of their table.
+
+        :param table_filters: Dictionnary table_name ("table" or "schema.table") => SQL predicate.
+        """
+        self.logger.debug("Table filters : %r", table_filters)
+        self._table_filters = table_filters
+        self.request_builder = None   # Unsetting dependent data
+
+    @property
+    def sample(self) -> model.Sample:
+        """
+        Sample of the FROM table that will be exported, None to export all rows matching the filters.
+        """
+        return self._sample
+
+    @sample.setter
+    def sample(self, sample: model.Sample):
+        """
+        Set the sample of the FROM table that will be exported.
+        Sampling is made before the JOINs so the extraction cost depends on the sample size.
+
+        :param sample: Sample of the FROM table, None to export all rows matching the filters.
+        """
+        self.logger.debug("Sample of the FROM table : %r", sample)
+        self._sample = sample
+
     @property
     def ignored_constraints(self) -> List[str]:
         """
@@ -109,7 +253,54 @@ class PgDumpFiltered():
         """
         self.logger.debug("Constraints that will be ignored : %s", ignored_constraints)
         self._ignored_constraints = ignored_constraints
-        self._schema_utils = SchemaUtils(conn=self._db_conn, ignored_constraints=self._ignored_constraints)
+        self._schema_utils = self._make_schema_utils()
+
+    @property
+    def excluded_columns(self) -> List[str]:
+        """
+        List of columns, as "table_name.column_name", that won't be exported.
+        They are removed from the SELECT statements and the COPY headers, restored rows will get the column DEFAULT.
+        """
+        return self._excluded_columns
+
+    @excluded_columns.setter
+    def excluded_columns(self, excluded_columns: List[str]):
+        """
+        Set excluded_columns, these columns won't be exported.
+
+        :param excluded_columns: List of columns, as "table_name.column_name".
+        """
+        self.logger.debug("Columns that will be excluded : %r", excluded_columns)
+        self._excluded_columns = excluded_columns
+        self.schema_utils = self._make_schema_utils()
+
+    @property
+    def column_substitutions(self) -> Dict[str, str]:
+        """
+        SQL expressions exported instead of the columns values, "table_name.column_name" => expression.
+        "{column}" in the expression is replaced by the column, see request_builder.SUBSTITUTE_NULL and request_builder.SUBSTITUTE_HASH.
+        """
+        return self._column_substitutions
+
+    @column_substitutions.setter
+    def column_substitutions(self, column_substitutions: Dict[str, str]):
+        """
+        Set column_substitutions, these expressions will be exported instead of the columns values.
+
+        :param column_substitutions: Dictionnary "table_name.column_name" => SQL expression.
+        """
+        self.logger.debug("Columns substitutions : %r", column_substitutions)
+        self._column_substitutions = column_substitutions
+        self.request_builder = None   # Unsetting dependent data
+
+    def _make_schema_utils(self, conn: psycopg2.extensions.connection=None) -> SchemaUtils:
+        """
+        Create a schema helper with the current settings.
+
+        :param conn: Connexion used by the helper. Default: the source connexion.
+        """
+        return SchemaUtils(
+            conn=conn if conn is not None else self._db_conn, ignored_constraints=self._ignored_constraints, excluded_columns=self._excluded_columns, schemas=self._schemas)
 
     @property
     def schema_utils(self) -> SchemaUtils:
@@ -117,7 +308,7 @@ class PgDumpFiltered():
         Schema helper.
         """
         if self._schema_utils is None:  # Lazy instanciation
-            self.schema_utils = SchemaUtils(conn=self._db_conn, ignored_constraints=self.ignored_constraints)
+            self.schema_utils = self._make_schema_utils()
         return self._schema_utils
 
     @schema_utils.setter
@@ -135,7 +326,10 @@ class PgDumpFiltered():
         Request builder.
         """
         if self._request_builder is None:   # Lazy instanciation
-            self._request_builder = RequestBuilder(schema_utils=self.schema_utils)
+            self._request_builder = RequestBuilder(
+                schema_utils=self.schema_utils,
+                column_substitutions=self.column_substitutions,
+                table_filters={self.schema_utils.qualify_table_name(table_name=t): f for t, f in self.table_filters.items()})
         return self._request_builder
 
     @request_builder.setter
@@ -152,6 +346,7 @@ class PgDumpFiltered():
         :param tables_to_export: Table names to be exported.
         :return: A tuple (tables_to_requests, join_statement)
         """
+        tables_to_export = [self.schema_utils.qualify_table_name(table_name=t) for t in tables_to_export]
         tables_to_request = self.schema_utils.list_all_related_tables(table_names=tables_to_export)
 
         self.logger.debug("Table to request : %r", tables_to_request)
@@ -164,34 +359,323 @@ class PgDumpFiltered():
 
         return (tables_to_request, join_req)
 
-    def dump(self, tables_to_export: List[str]):
+    def dump(self, tables_to_export: List[str], column_taps: Dict[str, Dict[str, ColumnTap]]=None):
         """
         Dump some tables and all related datas. Dump to the output file directly.
 
-        :param table_to_export: List of tables names that needs to be exported and all their related tables.
+        :param table_to_export: List of tables names ("table" or "schema.table") that needs to be exported and all their related tables.
+        :param column_taps: Callbacks or generators receiving the values of some columns while they are dumped, values are
+                            strings (None for NULL) as exported by COPY. table_name => {column_name => tap}.
         """
         self.logger.debug("Dump generation from %s")
+        if self.key_set_cache is not None and (self._session_profile.read_only or self._session_profile.deferrable or self._replica_used):
+            raise ValueError("Key sets are stored in temporary tables, they can't be created in a read only session or on a standby")
+        tables_to_export = [self.schema_utils.qualify_table_name(table_name=t) for t in tables_to_export]
+        if column_taps is not None:
+            column_taps = {self.schema_utils.qualify_table_name(table_name=t): taps for t, taps in column_taps.items()}
         tables_to_request, join_req = self.generate_tables_to_request_and_join(tables_to_export=tables_to_export)
 
+        unknown_filtered_tables = [
+            t for t in self.table_filters if self.schema_utils.qualify_table_name(table_name=t) not in tables_to_request]
+        if unknown_filtered_tables != []:
+            raise ValueError("Table filters on tables that aren't exported : {!r}".format(unknown_filtered_tables))
+
+        # taps are checked before anything is dumped, not when their table's COPY starts
+        if column_taps is not None:
+            unknown_tapped_tables = [t for t in column_taps if t not in tables_to_request]
+            if unknown_tapped_tables != []:
+                raise ValueError("Column taps on tables that aren't exported : {!r}".format(unknown_tapped_tables))
+            for tname, taps in column_taps.items():
+                cols_names = [c.column_name for c in self.schema_utils.fetch_exported_cols_names(table_name=tname)]
+                unknown_tapped_cols = [c for c in taps if c not in cols_names]
+                if unknown_tapped_cols != []:
+                    raise ValueError("Column taps on columns of {} that aren't exported : {!r}, exported columns are {!r}".format(
+                        tname, unknown_tapped_cols, cols_names))
+
         from_table_name = tables_to_export[0]  # Table that will be used in the FROM statment
+        from_statement = self.request_builder.generate_from_statement(from_table_name=from_table_name, sample=self.sample)
+        where_filter = self.request_builder.generate_where_filter(from_table_name=from_table_name, where_filter=self.sql_filters)
 
         # generating select statements
-        selects = self.request_builder.generate_all_select_statements(
-            table_to_be_exported=tables_to_request,
-            from_table_name=from_table_name,
-            join_statements=join_req,
-            where_filter=self.sql_filters)
+        key_set_builder = None
+        if self.key_set_cache is not None:
+            key_set_builder = self._prepare_key_sets(
+                tables_to_request=tables_to_request, from_statement=from_statement, join_req=join_req, where_filter=where_filter)
+            selects = {
+                tname: self.request_builder.generate_select_statement(
+                    from_table_name=make_keys_table_name(table_name=tname),
+                    displayed_fields_table_name=tname,
+                    join_statements=key_set_builder.generate_join_statement(table_name=tname),
+                    distinct=False)
+                if key_set_builder.has_key_set(table_name=tname) else
+                # tables without primary key have no key set, the JOINs are evaluated
+                self.request_builder.generate_select_statement(
+                    from_table_name=from_statement,
+                    displayed_fields_table_name=tname,
+                    join_statements=join_req,
+                    where_filter=where_filter)
+                for tname in tables_to_request}
+        else:
+            selects = self.request_builder.generate_all_select_statements(
+                table_to_be_exported=tables_to_request,
+                from_table_name=from_statement,
+                join_statements=join_req,
+                where_filter=where_filter)
+
+        budget_tracker = None
+        delete_budget_tracker = None
+        if self.table_budget is not None or self.total_budget is not None:
+            budget_tracker = BudgetTracker(table_budget=self.table_budget, total_budget=self.total_budget)
+            # delete statements are written before the datas, they are checked against the same budgets with their own counters
+            delete_budget_tracker = BudgetTracker(table_budget=self.table_budget, total_budget=self.total_budget)
 
         # Dumping datas
+        if self._target_conn is not None:
+            self.logger.debug("Start streaming datas to the target database")
+            connect = None
+            connect_target = None
+            if self.jobs > 1 and self._target_uri is not None:
+                connect_target = functools.partial(self._make_db_con_from_uri, db_uri=self._target_uri)
+            if self.jobs > 1 and self._db_uri is not None and self._target_uri is not None and key_set_builder is None:
+                if budget_tracker is not None:
+                    raise ValueError("Budgets can't be enforced with jobs > 1, each parallel session commits its own table")
+                # parallel sessions read the source datas with the snapshot of this session
+                connect = functools.partial(self._make_stream_connexions, snapshot=SessionUtils(conn=self._db_conn).export_snapshot())
+            dump_builder = StreamBuilder(
+                schema_utils=self.schema_utils,
+                conn=self._db_conn,
+                target_conn=self._target_conn,
+                restore_mode=self.restore_mode,
+                budget_tracker=budget_tracker,
+                column_taps=column_taps,
+                jobs=self.jobs,
+                delete_budget_tracker=delete_budget_tracker,
+                connect=connect,
+                connect_target=connect_target)
+            try:
+                self._run_dump_builder(
+                    dump_builder, from_statement=from_statement, tables_to_request=tables_to_request, join_req=join_req, selects=selects,
+                    where_filter=where_filter, key_set_builder=key_set_builder)
+                dump_builder.commit()
+            except Exception:
+                # with parallel sessions, the delete statements and the tables already streamed stay committed
+                self.logger.error("Dump failed, rolling back the target database transaction%s",
+                    "" if connect is None else ", tables already streamed by parallel sessions stay committed")
+                self._target_conn.rollback()
+                raise
+            return
+
         self.logger.debug("Start dumping datas to : %s", self.dump_file_path)
-        with open(self.dump_file_path, 'w') as dump_file:
-            dump_builder = DumpBuilder(schema_utils=self.schema_utils, conn=self._db_conn, dump_file=dump_file)
+        try:
+            with open(self.dump_file_path, 'w') as dump_file:
+                if self.pipeline and self.restore_mode == RESTORE_MODE_DELETE and self._db_uri is not None and key_set_builder is None:
+                    self._run_pipelined_dump(
+                        dump_file, budget_tracker=budget_tracker, delete_budget_tracker=delete_budget_tracker, column_taps=column_taps,
+                        from_statement=from_statement,
+                        tables_to_request=tables_to_request, join_req=join_req, selects=selects, where_filter=where_filter)
+                    return
+
+                dump_builder = DumpBuilder(
+                    schema_utils=self.schema_utils, conn=self._db_conn, dump_file=dump_file, restore_mode=self.restore_mode,
+                    budget_tracker=budget_tracker, column_taps=column_taps, delete_budget_tracker=delete_budget_tracker)
+                self._run_dump_builder(
+                    dump_builder, from_statement=from_statement, tables_to_request=tables_to_request, join_req=join_req, selects=selects,
+                    where_filter=where_filter, key_set_builder=key_set_builder)
+        except Exception as e:
+            self._mark_dump_file_failed(reason=str(e))
+            raise
+
+    def _mark_dump_file_failed(self, reason: str):
+        """
+        Leave the dump file in a clearly failed state : a failure comment is appended and the file is renamed with FAILED_DUMP_SUFFIX.
+
+        :param reason: Reason of the failure.
+        """
+        failed_path = str(self.dump_file_path) + FAILED_DUMP_SUFFIX
+        self.logger.error("Dump failed, incomplete dump moved to : %s", failed_path)
+        if not os.path.exists(str(self.dump_file_path)):
+            return
+
+        with open(str(self.dump_file_path), 'a') as dump_file:
+            dump_file.write(DP_FAILED.format(reason=reason.replace("\n", " ")))
+        os.replace(str(self.dump_file_path), failed_path)
+
+    def _prepare_key_sets(self, tables_to_request: List[str], from_statement: str, join_req: str, where_filter: str) -> KeySetBuilder:
+        """
+        Load the key sets from the cache, or evaluate the JOINs to create them and store them in the cache.
+
+        :param tables_to_request: Tables that will be exported.
+        :param from_statement: FROM statement of the requests.
+        :param join_req: JOIN statements of the requests.
+        :param where_filter: Filters of the WHERE statement of the requests.
+        :return: The key set builder, key sets are loaded in its temporary tables.
+        """
+        key_set_builder = KeySetBuilder(schema_utils=self.schema_utils, conn=self._db_conn)
+        cache_key = self.key_set_cache.make_key(
+            sql_filters=self.sql_filters,
+            table_filters=self.table_filters,
+            tables=tables_to_request,
+            ignored_constraints=self.ignored_constraints,
+            schema_fingerprint=self.schema_utils.fetch_schema_fingerprint(table_names=tables_to_request),
+            from_statement=from_statement)
+
+        key_sets = self.key_set_cache.get(key=cache_key)
+        if key_sets is not None:
+            self.logger.info("Using cached key sets")
+            key_set_builder.load_key_sets(key_sets=key_sets)
+        else:
+            key_sets = key_set_builder.create_key_sets(
+                from_table_name=from_statement,
+                table_to_be_exported=tables_to_request,
+                join_statements=join_req,
+                where_filter=where_filter)
+            self.key_set_cache.set(key=cache_key, key_sets=key_sets)
+
+        return key_set_builder
+
+    def _run_dump_builder(
+            self, dump_builder: DumpBuilder, from_statement: str, tables_to_request: List[str], join_req: str, selects: Dict[str, str],
+            where_filter: str=None, key_set_builder: KeySetBuilder=None):
+        """
+        Generate the delete statements (depending on the restore mode) and dump the tables datas.
+
+        :param dump_builder: Dump builder, writing to a file or streaming to a target database.
+        :param from_statement: FROM statement of the requests.
+        :param tables_to_request: Tables that will be exported.
+        :param join_req: JOIN statements of the requests.
+        :param selects: Dictionnary of select statement for each table (table_name => select statement)
+        :param where_filter: Filters of the WHERE statement of the requests.
+        :param key_set_builder: When set, primary keys to be deleted are read from its key sets instead of evaluating the JOINs.
+        """
+        self._generate_delete_statements(
+            dump_builder, from_statement=from_statement, tables_to_request=tables_to_request, join_req=join_req, where_filter=where_filter,
+            key_set_builder=key_set_builder)
+        self._dump_datas(dump_builder, tables_to_request=tables_to_request, selects=selects)
+
+    def _generate_delete_statements(
+            self, dump_builder: DumpBuilder, from_statement: str, tables_to_request: List[str], join_req: str, where_filter: str=None,
+            key_set_builder: KeySetBuilder=None):
+        """
+        Generate the delete statements, depending on the restore mode.
+
+        :param dump_builder: Dump builder, writing to a file or streaming to a target database.
+        :param from_statement: FROM statement of the requests.
+        :param tables_to_request: Tables that will be exported.
+        :param join_req: JOIN statements of the requests.
+        :param where_filter: Filters of the WHERE statement of the requests.
+        :param key_set_builder: When set, primary keys to be deleted are read from its key sets instead of evaluating the JOINs.
+        """
+        if self.restore_mode == RESTORE_MODE_DELETE and key_set_builder is not None:
+            for tname in tables_to_request:
+                if not key_set_builder.has_key_set(table_name=tname):
+                    # skipped with a warning by the dump builder, there is no primary key to delete by
+                    dump_builder.generate_primary_keys_delete_statements(
+                        from_table_name=from_statement, displayed_fields_table_name=tname, join_statements=join_req)
+                    continue
+
+                dump_builder.generate_primary_keys_delete_statements(
+                    from_table_name=make_keys_table_name(table_name=tname),
+                    displayed_fields_table_name=tname,
+                    join_statements=key_set_builder.generate_join_statement(table_name=tname))
+        elif self.restore_mode == RESTORE_MODE_DELETE:
             dump_builder.generate_all_delete_statements(
-                from_table_name=from_table_name,
+                from_table_name=from_statement,
                 table_to_be_exported=tables_to_request,
                 join_statements=join_req,
-                where_filter=self.sql_filters)
-            dump_builder.dump_tables(select_requests=selects)
+                where_filter=where_filter)
+
+    def _dump_datas(self, dump_builder: DumpBuilder, tables_to_request: List[str], selects: Dict[str, str]):
+        """
+        Dump the tables datas, with fast_load the secondary indexes are dropped around the datas.
+
+        :param dump_builder: Dump builder, writing to a file or streaming to a target database.
+        :param tables_to_request: Tables that will be exported.
+        :param selects: Dictionnary of select statement for each table (table_name => select statement)
+        """
+        indexes = dump_builder.drop_indexes(table_names=tables_to_request) if self.fast_load else []
+        dump_builder.dump_tables(select_requests=selects)
+        if self.fast_load:
+            dump_builder.create_indexes(indexes=indexes)
+            dump_builder.analyze_tables(table_names=tables_to_request)
+
+    def _run_pipelined_dump(
+            self, dump_file: TextIO, budget_tracker: BudgetTracker, delete_budget_tracker: BudgetTracker,
+            column_taps: Dict[str, Dict[str, ColumnTap]], from_statement: str, tables_to_request: List[str], join_req: str,
+            selects: Dict[str, str], where_filter: str=None):
+        """
+        Generate the delete statements on a second source connexion while the tables datas are dumped.
+        Datas are spooled in a temporary file, appended to the dump after the delete statements once both are done.
+        The second connexion imports a snapshot of the first one (see SessionUtils.export_snapshot).
+        When a stage fails the other one is cancelled and stops before its next table.
+
+        :param dump_file: Dump file.
+        :param budget_tracker: Enforce rows and bytes budgets on the COPY datas, None for no limit.
+        :param delete_budget_tracker: Enforce rows and bytes budgets on the delete statements, None for no limit.
+        :param column_taps: Callbacks or generators receiving the values of some columns while they are dumped.
+        :param from_statement: FROM statement of the requests.
+        :param tables_to_request: Tables that will be exported.
+        :param join_req: JOIN statements of the requests.
+        :param selects: Dictionnary of select statement for each table (table_name => select statement)
+        :param where_filter: Filters of the WHERE statement of the requests.
+        """
+        self.logger.debug("Pipelining delete statements and datas dump")
+        pipeline_conn = self._make_db_con_from_uri(db_uri=self._db_uri)
+        try:
+            snapshot = SessionUtils(conn=self._db_conn).export_snapshot()
+            SessionUtils(conn=pipeline_conn).import_snapshot(snapshot=snapshot, profile=self._session_profile)
+
+            stop_event = threading.Event()
+            delete_builder = DumpBuilder(
+                schema_utils=self._make_schema_utils(conn=pipeline_conn), conn=pipeline_conn, dump_file=dump_file, restore_mode=self.restore_mode,
+                delete_budget_tracker=delete_budget_tracker, stop_event=stop_event)
+            spool_dir = os.path.dirname(os.path.abspath(str(self.dump_file_path)))
+            with tempfile.TemporaryFile(mode='w+', dir=spool_dir) as spool_file:
+                data_builder = DumpBuilder(
+                    schema_utils=self.schema_utils, conn=self._db_conn, dump_file=spool_file, restore_mode=self.restore_mode,
+                    budget_tracker=budget_tracker, column_taps=column_taps, header=False, stop_event=stop_event)
+
+                def stop_datas_dump(future):
+                    # the delete stage failed, the datas dump is cancelled instead of running until its end
+                    if future.exception() is not None and not stop_event.is_set():
+                        stop_event.set()
+                        self._db_conn.cancel()
+
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    deletes_future = executor.submit(
+                        self._generate_delete_statements,
+                        delete_builder, from_statement=from_statement, tables_to_request=tables_to_request, join_req=join_req,
+                        where_filter=where_filter)
+                    deletes_future.add_done_callback(stop_datas_dump)
+                    try:
+                        self._dump_datas(data_builder, tables_to_request=tables_to_request, selects=selects)
+                    except Exception:
+                        if stop_event.is_set():
+                            # cancelled by the delete stage, its error is the one to report
+                            deletes_future.result()
+                            raise
+                        stop_event.set()
+                        pipeline_conn.cancel()
+                        raise
+                    deletes_future.result()
+
+                spool_file.seek(0)
+                shutil.copyfileobj(spool_file, dump_file)
+        finally:
+            pipeline_conn.close()
+
+    def _make_stream_connexions(self, snapshot: str=None) -> Tuple[psycopg2.extensions.connection, psycopg2.extensions.connection]:
+        """
+        Create a new couple of source and target connexions, used to stream tables in parallel.
+
+        :param snapshot: Snapshot imported by the source connexion (see SessionUtils.export_snapshot), None for a new snapshot.
+        :return: A tuple (source connexion, target connexion)
+        """
+        conn = self._make_db_con_from_uri(db_uri=self._db_uri)
+        if snapshot is not None:
+            SessionUtils(conn=conn).import_snapshot(snapshot=snapshot, profile=self._session_profile)
+        else:
+            SessionUtils(conn=conn).apply_profile(profile=self._session_profile)
+        return (conn, self._make_db_con_from_uri(db_uri=self._target_uri))
 
     def close(self):
         """
@@ -199,3 +683,5 @@ class PgDumpFiltered():
         """
         self.logger.debug("Closing database connexion")
         self._db_conn.close()
+        if self._target_conn is not None:
+            self._target_conn.close()